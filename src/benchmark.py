@@ -0,0 +1,460 @@
+"""
+This script measures the throughput and memory of the processing steps on synthetic data.
+The fixtures are generated offline and deterministically, so results can be compared across
+commits. They are written to data/benchmark/<commit>-<mode>.json by default.
+
+    Mode:
+        - composite: compositing kernel against the former color_jitter + add_mask
+        - alloc: per frame memory churn of create_mask, before and with the reused buffers
+        - pack: samples/sec written and read at random as loose files and as packed tar shards
+        - import: import time and cold start of every entry point in a fresh interpreter, failing
+                  when over its budget or when a visualization module gets loaded
+        - suite: create_mask frames/sec (full and fast search), create images/sec (loose, packed and
+                 at 416x416), count latency and peak RSS on a synthetic video and a small COCO style tree
+"""
+import argparse
+from contextlib import redirect_stdout
+import cv2
+import io
+import json
+import multiprocessing as mp
+import numpy as np
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+import tracemalloc
+from createDataset import createDataset
+from labelIndex import labelIndex
+from packShard import packDataset, packShardWriter
+from yoloMask import generateMask
+
+# import time budget of the entry points in ms, over that of cv2 and numpy alone
+IMPORT_BUDGET = {'yoloMask': 100, 'createDataset': 100, 'packShard': 50}
+# modules the entry points must not load at import
+HEAVY = ['matplotlib', 'PIL', 'scipy', 'pandas']
+
+def measure(fn, n):
+    """runs fn n times and returns (runs per second, peak bytes allocated by a run)"""
+    fn()    # warm up
+
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    rate = n / (time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return rate, peak
+
+def synthetic_mask(h, w):
+    """bright ellipse on black, like a mask cropped to its bbox"""
+    mask = np.zeros((h, w, 3), dtype=np.uint8)
+    cv2.ellipse(mask, (w//2, h//2), (w//2 - 1, h//2 - 1), 0, 0, 360, (40, 200, 230), cv2.FILLED)
+    return mask
+
+def legacy_color_jitter(c, img):
+    """createDataset.color_jitter as it was before the LUT kernel, for comparison"""
+    # define filter not to distort the background
+    filt = (img != 0)
+
+    a = c.rng.uniform(0.5, 1.5)
+    b = c.rng.uniform(-100, 100)
+    img = (a * img + b).astype(np.int64)
+    img = np.clip(img, 0, 255)
+    img *= filt
+
+    return img
+
+def legacy_add_mask(c, bg, mask):
+    """createDataset.add_mask as it was before the in-place kernel, for comparison"""
+    # if mask is to tall for the background image, decrease the size by 50%
+    if bg.shape[0] < mask.shape[0]:
+        mask = cv2.resize(mask, (int(0.5*mask.shape[1]), int(0.5*mask.shape[0])), interpolation=cv2.INTER_AREA)
+    h_mask, w_mask = mask.shape[:2]
+    h, w = bg.shape[:2]
+
+    # select random location for mask
+    h_update, w_update = c.place(h, w, h_mask, w_mask)
+
+    # place the mask in the bg img
+    filt = (mask == 0)
+    mod = bg.copy()
+    mod[h_update:h_update+h_mask, w_update:w_update+w_mask, :] *= filt
+    mod[h_update:h_update+h_mask, w_update:w_update+w_mask, :] += mask
+
+    return mod, c.yolo_dim(h, w, h_update, w_update, h_mask, w_mask)
+
+def bench_composite(n, size):
+    """images/sec and peak memory of compositing a mask onto a background"""
+    rng = np.random.RandomState(0)
+    bg = rng.randint(0, 255, (size[1], size[0], 3)).astype(np.uint8)
+    mask = synthetic_mask(size[1] // 3, size[0] // 3)
+
+    c = createDataset()
+    c.set_seed(0)
+
+    def legacy():
+        legacy_add_mask(c, bg, legacy_color_jitter(c, mask).astype(np.uint8))
+
+    def kernel():
+        c.paste_mask(bg, mask)
+
+    res = {}
+    for name, fn, feather in [('legacy', legacy, 0), ('kernel', kernel, 0), ('feathered', kernel, 2.0)]:
+        c.set_feather(feather)
+        rate, peak = measure(fn, n)
+        res[name] = {'images_per_sec': rate, 'peak_bytes': peak}
+        print(f'[BENCH] {name}: {rate:.1f} images/sec, peak {peak / 2**20:.2f} MB')
+
+    return res
+
+def legacy_create_mask(gen, frame):
+    """create_mask as it was before the bbox-local masking and the buffers, for comparison"""
+    c, bbox = gen.find_object(frame)
+    mask = np.zeros((frame.shape[0], frame.shape[1]))
+    cv2.drawContours(mask, [c], -1, (1,0,0), cv2.FILLED)
+    masked = frame.copy()
+    for i in range(3):
+        masked[:, :, i] *= (mask != 0)
+    return masked, bbox
+
+def bench_alloc(n, size):
+    """
+    per frame memory churn of create_mask: peak bytes allocated by a call, traced by
+    tracemalloc, and minor page faults, i.e. freshly allocated pages touched. The arrays of
+    a call are freed before it returns, so only the peak shows them, at 4K by default
+    """
+    w, h = size
+    frame = np.full((h, w, 3), 12, dtype=np.uint8)
+    cv2.ellipse(frame, (w // 2, h // 2), (w // 10, h // 8), 30, 0, 360, (40, 200, 230), cv2.FILLED)
+
+    res = {}
+    for name in ['legacy', 'create_mask', 'reuse', 'reuse_fast']:
+        gen = generateMask()
+        gen.set_thresh((100, 255))
+        gen.set_buffers(name.startswith('reuse'))
+        gen.set_search('fast' if name.endswith('fast') else 'full')
+        fn = (lambda: legacy_create_mask(gen, frame)) if name == 'legacy' else (lambda: gen.create_mask(frame))
+
+        rate, peak = measure(fn, n)
+        faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+        for _ in range(n):
+            fn()
+        faults = (resource.getrusage(resource.RUSAGE_SELF).ru_minflt - faults) / n
+        res[name] = {'frames_per_sec': rate, 'peak_bytes': peak, 'page_faults': faults}
+        print(f'[BENCH] {name}: {rate:.1f} frames/sec, peak {peak / 2**20:.2f} MB, {faults:.0f} page faults/frame')
+
+    return res
+
+def bench_pack(root, n, size, cap=64):
+    """
+    samples/sec of writing n encoded images and their label lines as loose files and into
+    packed tar shards of cap MB, and of reading them back in random order
+    """
+    w, h = size
+    rng = np.random.RandomState(0)
+    img = cv2.GaussianBlur(rng.randint(0, 255, (h, w, 3)).astype(np.uint8), (0, 0), 3)
+    image = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 95])[1].tobytes()
+    label = '2 0.5 0.5 0.25 0.25\n'
+    order = rng.permutation(n)
+
+    shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(f'{root}/loose/images')
+    os.makedirs(f'{root}/loose/labels')
+
+    res = {}
+    start = time.perf_counter()
+    for i in range(n):
+        with open(f'{root}/loose/images/bench{i}.jpg', 'wb') as f:
+            f.write(image)
+        with open(f'{root}/loose/labels/bench{i}.txt', 'w') as f:
+            f.write(label)
+    write = n / (time.perf_counter() - start)
+    start = time.perf_counter()
+    for i in order:
+        with open(f'{root}/loose/images/bench{i}.jpg', 'rb') as f:
+            f.read()
+        with open(f'{root}/loose/labels/bench{i}.txt', 'r') as f:
+            f.read()
+    res['loose'] = {'write_per_sec': write, 'read_per_sec': n / (time.perf_counter() - start), 'files': 2 * n}
+
+    start = time.perf_counter()
+    pack = packShardWriter(f'{root}/packed/bench', cap * 2**20)
+    for i in range(n):
+        pack.add(f'bench{i}', image, label)
+    pack.close()
+    write = n / (time.perf_counter() - start)
+    with open(f'{root}/packed/bench.txt', 'w') as f:
+        f.write(''.join(path + '\n' for path in pack.paths))
+    start = time.perf_counter()
+    data = packDataset(f'{root}/packed/bench.txt')
+    for i in order:
+        _, buf, _ = data[i]
+        buf.tobytes()
+    res['packed'] = {'write_per_sec': write, 'read_per_sec': n / (time.perf_counter() - start), 'files': 2 * len(pack.paths)}
+
+    for name, item in res.items():
+        print(f'[BENCH] {name}: {item["write_per_sec"]:.0f} samples/sec written, '
+              f'{item["read_per_sec"]:.0f} samples/sec read, {item["files"]} files')
+    shutil.rmtree(root, ignore_errors=True)
+
+    return res
+
+def import_time(modules, n):
+    """best of n import times in ms of modules in a fresh interpreter, with the HEAVY modules it loads"""
+    code = ('import time; start = time.perf_counter(); import ' + modules + '; elapsed = time.perf_counter() - start; '
+            f'import json, sys; print(json.dumps([1000 * elapsed, [m for m in {HEAVY!r} if m in sys.modules]]))')
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    runs = [json.loads(subprocess.run([sys.executable, '-c', code], cwd=cwd, capture_output=True, text=True,
+                                      check=True).stdout) for _ in range(n)]
+    return min(ms for ms, _ in runs), runs[0][1]
+
+def cold_start(script, n):
+    """best of n wall times in ms of running script -h, interpreter startup included"""
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    best = float('inf')
+    for _ in range(n):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, script, '-h'], cwd=cwd, capture_output=True, check=True)
+        best = min(best, 1000 * (time.perf_counter() - start))
+    return best
+
+def bench_import(n):
+    """import time and cold start of the entry points against IMPORT_BUDGET"""
+    base, _ = import_time('cv2, numpy', n)
+    print(f'[BENCH] cv2 and numpy: {base:.1f} ms')
+    res = {'base_ms': base}
+    for name, budget in IMPORT_BUDGET.items():
+        ms, heavy = import_time(name, n)
+        item = {'import_ms': ms, 'over_base_ms': ms - base, 'budget_ms': budget,
+                'cold_start_ms': cold_start(name + '.py', n), 'heavy': heavy}
+        item['ok'] = item['over_base_ms'] <= budget and not heavy
+        res[name] = item
+        print(f'[BENCH] {name}: import {ms:.1f} ms ({ms - base:+.1f} ms, budget {budget}), '
+              f'cold start {item["cold_start_ms"]:.1f} ms' + (f', loads {", ".join(heavy)}' if heavy else '')
+              + ('' if item['ok'] else ' FAIL'))
+
+    return res
+
+def make_video(path, frames, size):
+    """synthetic video of a bright ellipse moving and turning on a dark background"""
+    w, h = size
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 30, (w, h))
+    for i in range(frames):
+        frame = np.full((h, w, 3), 12, dtype=np.uint8)
+        center = (int(w * (0.2 + 0.6 * i / frames)), int(h * (0.4 + 0.2 * np.sin(i / 10))))
+        cv2.ellipse(frame, center, (w // 10, h // 8), 3 * i, 0, 360, (40, 200, 230), cv2.FILLED)
+        writer.write(frame)
+    writer.release()
+
+def make_coco(root, images, size):
+    """small COCO style images/ and labels/ tree with the same label format"""
+    rng = np.random.RandomState(0)
+    for split in ['train', 'val']:
+        os.makedirs(f'{root}/images/{split}', exist_ok=True)
+        os.makedirs(f'{root}/labels/{split}', exist_ok=True)
+        for i in range(images):
+            w = rng.randint(size[0] // 2, size[0] + 1)
+            h = rng.randint(size[1] // 2, size[1] + 1)
+            # smooth random background, cheap to encode like a photo
+            img = cv2.resize(rng.randint(0, 255, (h // 16, w // 16, 3)).astype(np.uint8), (w, h))
+            if i % 20 == 7:
+                img = img[..., 0]   # a few grayscale images, as in COCO
+            cv2.imwrite(f'{root}/images/{split}/COCO_{split}_{i:012d}.jpg', img)
+
+            lines = []
+            for _ in range(rng.randint(1, 6)):
+                cls = rng.choice([0, 2, 5, 39, 41, 56, 60])
+                x, y = rng.uniform(0.05, 0.95, 2)
+                bw, bh = rng.uniform(0.05, 0.6, 2)
+                lines.append(f'{cls} {x:.6f} {y:.6f} {bw:.6f} {bh:.6f}')
+            with open(f'{root}/labels/{split}/COCO_{split}_{i:012d}.txt', 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+
+def make_masks(root, video):
+    """masks of the synthetic video and their bbox file, in the format of yoloMask.py"""
+    os.makedirs(f'{root}/mask', exist_ok=True)
+    gen = generateMask()
+    gen.set_thresh((100, 255))
+    cap = gen.load_video(video)
+    with open(f'{root}/mask/bench_mask_bbox.txt', 'w') as f:
+        for num, (ind, frame) in enumerate(gen.sample_frames(cap, stride=10)):
+            masked, bbox = gen.create_mask(frame)
+            maskname = f'{root}/mask/bench_mask_{num}.jpg'
+            cv2.imwrite(maskname, masked)
+            f.write(f'{maskname},{(bbox[0], bbox[1])},{(bbox[2], bbox[3])}\n')
+    cap.release()
+
+def fixtures(root, frames, images, size):
+    """generates the deterministic fixtures once and returns their paths"""
+    paths = {'video': f'{root}/bench.avi', 'coco': f'{root}/coco',
+             'bbox': f'{root}/mask/bench_mask_bbox.txt', 'det': f'{root}/out/'}
+    stamp = f'{root}/fixtures.json'
+    params = {'frames': frames, 'images': images, 'size': list(size)}
+    if os.path.exists(stamp):
+        with open(stamp, 'r') as f:
+            if json.load(f) == params:
+                return paths
+
+    print('[BENCH] generating fixtures')
+    shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(root)
+    make_video(paths['video'], frames, size)
+    make_coco(paths['coco'], images, size)
+    make_masks(root, paths['video'])
+    with open(stamp, 'w') as f:
+        json.dump(params, f)
+
+    return paths
+
+def isolated(fn, *args):
+    """runs fn(*args) in a fresh process and adds its peak RSS in bytes to the result"""
+    with mp.get_context('spawn').Pool(1) as pool:
+        return pool.apply(_peak_rss, (fn, args))
+
+def _peak_rss(fn, args):
+    with redirect_stdout(io.StringIO()):
+        res = fn(*args)
+    res['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return res
+
+def bench_create_mask(video, search='full'):
+    """frames/sec of generateMask.create_mask, decode excluded"""
+    gen = generateMask()
+    gen.set_thresh((100, 255))
+    gen.set_search(search)
+    cap = gen.load_video(video)
+    frames = [frame for _, frame in gen.sample_frames(cap, stride=1)]
+    cap.release()
+
+    gen.create_mask(frames[0])
+    start = time.perf_counter()
+    for frame in frames:
+        gen.create_mask(frame)
+    elapsed = time.perf_counter() - start
+
+    return {'frames': len(frames), 'seconds': elapsed, 'frames_per_sec': len(frames) / elapsed}
+
+def bench_create(paths, size, pack=0, out=0):
+    """
+    images/sec of createDataset.create, label index already cached, into packed shards
+    of pack MB and at the training resolution out if set
+    """
+    shutil.rmtree(paths['det'], ignore_errors=True)
+    c = createDataset()
+    c.set_target('39,41')
+    c.set_size(size)
+    c.set_seed(0)
+    c.set_bank(paths['bbox'])
+    c.set_output(pack=pack)
+    c.set_resolution(out)
+    c.load_labels(paths['coco'] + '/labels/train/')
+    c.set_dest('train', paths['det'], 'bench')
+
+    start = time.perf_counter()
+    c.create()
+    elapsed = time.perf_counter() - start
+    if pack:
+        images = len(packDataset(c.detList))
+    else:
+        images = len(os.listdir(paths['det'] + 'images/train'))
+
+    return {'images': images, 'seconds': elapsed, 'images_per_sec': images / elapsed}
+
+def bench_count(paths):
+    """latency of count mode, with the label index built from scratch and cached"""
+    pathLabel = paths['coco'] + '/labels/val/'
+    res = {}
+    for name in ['cold', 'warm']:
+        if name == 'cold':
+            cache = labelIndex(pathLabel).cache_file()
+            os.remove(cache)
+        start = time.perf_counter()
+        c = createDataset()
+        c.set_target('39,41')
+        c.load_labels(pathLabel)
+        c.count_target()
+        res[f'{name}_seconds'] = time.perf_counter() - start
+
+    return res
+
+def git_commit():
+    """current commit of the repo, None outside a git checkout"""
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                             capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench_suite(root, frames, images, size):
+    """runs every benchmark on the fixtures, each in its own process"""
+    paths = fixtures(root, frames, images, size)
+    res = {}
+    res['create_mask'] = isolated(bench_create_mask, paths['video'])
+    res['create_mask_fast'] = isolated(bench_create_mask, paths['video'], 'fast')
+    res['create'] = isolated(bench_create, paths, images // 2)
+    res['create_packed'] = isolated(bench_create, paths, images // 2, 64)
+    res['create_416'] = isolated(bench_create, paths, images // 2, 0, 416)
+    res['count'] = isolated(bench_count, paths)
+    for name, item in res.items():
+        print(f'[BENCH] {name}: ' + ', '.join(f'{k} {v:.4g}' for k, v in item.items()))
+
+    return res
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark the processing steps.')
+    ap.add_argument('-m', '--mode', required=True, help='composite, alloc, pack, import or suite')
+    ap.add_argument('-n', '--num', type=int, default=200, help='number of runs in composite and alloc mode, samples in pack mode, '
+                                                              'interpreters in import mode')
+    ap.add_argument('--size', type=int, nargs=2, default=None, help='image width and height (default 3840 2160 in alloc mode, '
+                                                                     'where the buffers reused matter, 640 480 otherwise)')
+    ap.add_argument('--frames', type=int, default=150, help='frames of the synthetic video')
+    ap.add_argument('--images', type=int, default=200, help='images per split of the synthetic COCO tree')
+    ap.add_argument('--fixtures', default=None, help='fixture directory (default data/benchmark/fixtures)')
+    ap.add_argument('-o', '--output', default=None, help='JSON file to write the results to (default data/benchmark/<commit>.json)')
+    args = vars(ap.parse_args())
+
+    # mode assertion
+    assert(args['mode'] in ['composite', 'alloc', 'pack', 'import', 'suite']), 'Mode should be one of the followings: \'composite\', \'alloc\', \'pack\', \'import\', \'suite\''
+
+    if args['size'] is None:
+        args['size'] = [3840, 2160] if args['mode'] == 'alloc' else [640, 480]
+
+    PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data', 'benchmark'))
+    commit = git_commit()
+
+    res = {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'mode': args['mode'],
+           'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__,
+           'params': {k: args[k] for k in ['num', 'size', 'frames', 'images']}}
+    if args['mode'] == 'composite':
+        res['results'] = {'composite': bench_composite(args['num'], args['size'])}
+    elif args['mode'] == 'alloc':
+        res['results'] = {'alloc': bench_alloc(args['num'], args['size'])}
+    elif args['mode'] == 'pack':
+        res['results'] = {'pack': bench_pack(PATH + '/pack', args['num'], args['size'])}
+    elif args['mode'] == 'import':
+        res['results'] = {'import': bench_import(args['num'])}
+    else:
+        root = args['fixtures'] or PATH + '/fixtures'
+        res['results'] = bench_suite(root, args['frames'], args['images'], args['size'])
+
+    output = args['output'] or PATH + f'/{commit or "results"}-{args["mode"]}.json'
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(res, f, indent=2)
+    print(f'[BENCH] results written to {output}')
+
+    # a failed import budget fails the run
+    if args['mode'] == 'import' and not all(item['ok'] for item in res['results']['import'].values() if isinstance(item, dict)):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+This script contains the compositing kernel used by createDataset. The mask is pasted in place,
+touching only the region of the background under the mask. Brightness and contrast go through a
+uint8 lookup table, and the alpha is computed once per mask.
+"""
+import cv2
+import numpy as np
+
+def jitter_lut(a, b):
+    """
+    returns the uint8 lookup table of a * v + b, clipped to 0-255, truncating the same
+    way as the former color_jitter, see benchmark.legacy_color_jitter
+    """
+    lut = (a * np.arange(256) + b).astype(np.int64)
+
+    return np.clip(lut, 0, 255).astype(np.uint8)
+
+def blend_alpha(mask, feather=0):
+    """
+    returns the alpha of a mask, a uint8 0/1 array, or float32 weights if feathered
+
+    args:
+        mask: 2D array nonzero on the object, or image with any channel nonzero on it
+        feather: sigma in pixels of the Gaussian blur softening the edges. The edges
+                 are only softened inward, so nothing outside the mask is blended in
+    """
+    if mask.ndim == 3:
+        channels = cv2.split(mask)
+        mask = channels[0]
+        for channel in channels[1:]:
+            mask = cv2.bitwise_or(mask, channel)
+    alpha = cv2.compare(mask, 0, cv2.CMP_NE) // 255
+    if feather <= 0:
+        return alpha
+
+    soft = cv2.GaussianBlur(alpha.astype(np.float32), (0, 0), feather)
+    soft *= alpha
+
+    return soft
+
+def paste(bg, fg, alpha, top, left, lut=None):
+    """
+    pastes fg onto bg in place, with its top left corner at (top, left)
+
+    args:
+        bg: background image, modified in place
+        fg: foreground image, same channel order as bg
+        alpha: alpha from blend_alpha, same height and width as fg
+        lut: optional uint8 lookup table applied to fg, see jitter_lut
+    """
+    h, w = fg.shape[:2]
+    roi = bg[top:top+h, left:left+w]
+    if lut is not None:
+        fg = cv2.LUT(fg, lut)
+
+    if alpha.dtype == np.uint8:
+        cv2.copyTo(fg, alpha, roi)
+    else:
+        roi[...] = cv2.blendLinear(fg, roi, alpha, 1.0 - alpha)
+
+    return bg
+
+def free_positions(h, w, h_mask, w_mask, boxes, max_iou, cells=128):
+    """
+    returns the grid of top left positions where a h_mask x w_mask box fits in an h x w
+    image with an IoU of at most max_iou against each of the boxes already placed
+
+    the overlap with each box is computed for whole rows and columns of the grid at once,
+    as the product of the overlaps of the intervals along y and along x
+
+    args:
+        boxes: list of (top, left, bottom, right)
+        cells: max number of grid positions along each axis
+
+    returns:
+        tops, lefts, ok: ok[i, j] tells whether (tops[i], lefts[j]) is free
+    """
+    step = max(1, max(h, w) // cells)
+    tops = np.arange(0, h - h_mask + 1, step)
+    lefts = np.arange(0, w - w_mask + 1, step)
+    ok = np.ones((len(tops), len(lefts)), dtype=bool)
+
+    area = h_mask * w_mask
+    for top, left, bottom, right in boxes:
+        ih = np.clip(np.minimum(tops + h_mask, bottom) - np.maximum(tops, top), 0, None)
+        iw = np.clip(np.minimum(lefts + w_mask, right) - np.maximum(lefts, left), 0, None)
+        inter = np.outer(ih, iw)
+        union = area + (bottom - top) * (right - left) - inter
+        ok &= inter <= max_iou * union
+
+    return tops, lefts, ok
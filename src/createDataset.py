@@ -7,227 +7,673 @@ This script is to create a dataset to train YOLO by adding custom object masks t
 https://github.com/sohn21c/yoloMask
 """
 import argparse
+from collections import deque
+import composite
+from concurrent.futures import ThreadPoolExecutor
+import copy
 import cv2
-import matplotlib.image as mpimg
+import imgio
+import instrument
+import manifest
+import multiprocessing as mp
 import numpy as np
 import os
+import resolution
+import shutil
+import transform
 import util
+from labelIndex import labelIndex
+from maskBank import maskBank
+from packShard import packShardWriter
 
 class createDataset(object):
     def __init__(self):
-        pass
+        self.rng = np.random.mtrand._rand   # global random state unless seeded
+        self.seed = None    # base seed of the synthetic images, drawn from rng if not set
+        self.feather = 0    # edge feathering of the pasted masks in pixels
+        self.holdout = None # split, share and block of the masks held out, see set_holdout
+        self.set_augment()
+        self.set_objects()
+        self.set_output()
+        self.set_stats()
+        self.set_manifest()
+        self.set_sampler()
+        self.set_resolution()
+
+    @instrument.timed('add_mask')
+    def paste_mask(self, bg, mask, alpha=None, boxes=None):
+        """
+        adds processed mask to the background in place, jittering its color
+
+        same random draws as the former color_jitter followed by add_mask (see benchmark),
+        but only the region of the background under the mask is touched and no full-size
+        temporary is made.
+        If boxes is given, the mask is placed where it overlaps none of the boxes by more
+        than self.maxIou, its box is appended to boxes, and dim is None if there is no room
+        """
+        a = self.rng.uniform(0.5, 1.5)
+        b = self.rng.uniform(-100, 100)
+        lut = composite.jitter_lut(a, b)
+        if alpha is None:
+            alpha = mask
 
-    def add_mask(self, bg, mask):
-        """adds processed mask to the backround"""
         # if mask is to tall for the background image, decrease the size by 50%
-        if bg.shape[0] < mask.shape[0]:
-            mask = cv2.resize(mask, (int(0.5*mask.shape[0]), int(0.5*mask.shape[1])), interpolation=cv2.INTER_AREA)
+        while bg.shape[0] < mask.shape[0]:
+            mask = cv2.resize(mask, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
+            alpha = cv2.resize(alpha, (mask.shape[1], mask.shape[0]), interpolation=cv2.INTER_NEAREST)
         h_mask, w_mask = mask.shape[:2]
         h, w = bg.shape[:2]
-        
-        # select random location for mask
-        h_rand = np.random.rand() * 0.9
+
+        if boxes is None:
+            h_update, w_update = self.place(h, w, h_mask, w_mask)
+        else:
+            tops, lefts, ok = composite.free_positions(h, w, h_mask, w_mask, boxes, self.maxIou)
+            free = np.flatnonzero(ok)
+            if len(free) == 0:
+                return bg, None
+            i, j = np.unravel_index(free[self.rng.randint(len(free))], ok.shape)
+            h_update, w_update = int(tops[i]), int(lefts[j])
+            boxes.append((h_update, w_update, h_update + h_mask, w_update + w_mask))
+
+        alpha = composite.blend_alpha(alpha, self.feather)
+        composite.paste(bg, mask, alpha, h_update, w_update, lut)
+
+        return bg, self.yolo_dim(h, w, h_update, w_update, h_mask, w_mask)
+
+    def composite_image(self, bg):
+        """
+        pastes self.objects randomly chosen and transformed masks onto the background in
+        place, and returns it with the YOLO dims and the bank indices of the pasted masks.
+        Masks that find no room under the IoU limit are skipped
+        """
+        boxes = [] if self.objects > 1 else None
+        dims = []
+        masks = []
+        for _ in range(self.objects):
+            with self.stats.stage('choose_mask'):
+                maskInd, sliced = self.bank.sample(self.rng)
+            ratio = self.rng.rand()
+            ratio *= 0.5
+            ratio = np.clip(ratio, 0.1, 0.5)
+            targetWidth = int(ratio * bg.shape[1])
+            rot, flip, shear = self.random_transform()
+            resized, alpha = self.transform_mask(sliced, targetWidth, rot, self.bank.get_alpha(maskInd), flip, shear)
+            bg, dim = self.paste_mask(bg, resized, alpha, boxes)
+            if dim is not None:
+                dims.append(dim)
+                masks.append(maskInd)
+                self.stats.count('masks_pasted')
+            else:
+                self.stats.count('masks_no_room')
+
+        return bg, dims, masks
+
+    def place(self, h, w, h_mask, w_mask):
+        """selects random location for mask"""
+        h_rand = self.rng.rand() * 0.9
         h_rand = np.clip(h_rand, 0, 1.0 - h_mask/h)
         h_update = int(h_rand * h)
-        w_rand = np.random.rand() * 0.9
+        w_rand = self.rng.rand() * 0.9
         w_rand = np.clip(w_rand, 0, 1.0 - w_mask/w)
         w_update = int(w_rand * w)
-        
-        # define filter for a mask
-        filt = (mask == 0)
-        
-        # place the mask in the bg img
-        mod = bg.copy()
-        mod[h_update:h_update+h_mask, w_update:w_update+w_mask, :] *= filt
-        mod[h_update:h_update+h_mask, w_update:w_update+w_mask, :] += mask
-        
-        # yolo dim for mask
+
+        return h_update, w_update
+
+    def yolo_dim(self, h, w, h_update, w_update, h_mask, w_mask):
+        """yolo dim for mask"""
         locy = (h_update+h_update+h_mask)/2/h
         locx = (w_update+w_update+w_mask)/2/w
         sizey = (h_mask/h)
         sizex = (w_mask/w)
-        
-        dim = [locx, locy, sizex, sizey]
-        
-        return mod, dim
-
-    def choose_mask(self, bboxFile):
-        """randomly chooses the object mask"""
-        f = open(bboxFile, 'r')
-        content = f.read().split('\n')
-        ind = np.random.randint(len(content) - 1)
-        line = content[ind]
-        words = line.split(',')
-
-        maskFile = words[0]
-        maskCoord = []
-
-        for item in words[1:]:
-            item = util.strip_paren(item)
-            item = item.lstrip().rstrip()
-            maskCoord.append(item)
-
-        f.close()
-
-        return maskFile, maskCoord
-
-    def color_jitter(self, img):
-        """randomly changes brightness and contrast of an image"""
-        # define filter not to distort the background
-        filt = (img != 0)
-        
-        a = np.random.uniform(0.5, 1.5)
-        b = np.random.uniform(-100, 100)
-        img = (a * img + b).astype(np.int64)
-        img = np.clip(img, 0, 255)
-        img *= filt
-
-        return img
-        
+
+        return [locx, locy, sizex, sizey]
+
     def count_target(self):
         """counts the number of objects for detection in MS-COCO dataset"""
-        tally = {}
-        for obj in self.target:
-            tally[obj] = 0
-
-        ind = 0
-        for label in self.labelList:
-            filename = self.pathLabel + label
-            f = open(filename, 'r')
-            content = f.read().split('\n')
-            for line in content:
-                items = line.split(' ')
-                if items[0] in self.target:
-                    tally[items[0]] += 1
-            f.close()
-            if ind % 100 == 0:
-                print(f'[COUNT] {ind} of {len(self.labelList)} processed')
-            ind += 1
-        
+        counts = self.index.count([int(obj) for obj in self.target])
+        tally = {obj: counts[int(obj)] for obj in self.target}
+
         print('[COUNT] done counting targets in dataset')
         print(tally)
 
     def create(self):
         """create dataset"""
-        new_image = 0   # counter
+        self.transform_labels()
+        self.open_manifest()
+        self.stats.reset()
+        self.select_backgrounds(self.seed)
         fnewList = open(self.detList, 'w')
+        self.create_shard(range(len(self.labelList)), fnewList, self.manifestPath, 0)
+        self.close_manifest()
 
-        ind = 0 # for-loop counter
-        for ind in range(len(self.labelList)):
-            labelName = self.pathLabel + self.labelList[ind]
-            flabel = open(labelName, 'r')
-            content = flabel.read().split('\n')
-            change = False  # change flag 
+        print(f'[INFO] done creating dataset')
+        fnewList.close()
+        self.stats.report()
+
+    def create_parallel(self, workers, shards=None, seed=None):
+        """
+        create dataset in worker processes
+
+        labelList is split into contiguous shards, each making the synthetic images of
+        the backgrounds picked by select_backgrounds within it. Every synthetic image has
+        its own seed, see seeded, so given the same seed, the dataset is byte-identical
+        to the one of create whatever the number of shards. The manifests and stats of
+        the shards are merged once they are done.
+        """
+        if shards is None:
+            shards = workers
+        if seed is not None:
+            self.set_seed(seed)
+        self.transform_labels()
+        self.open_manifest()
+        self.stats.reset()
+        self.select_backgrounds(self.seed)
+        n = len(self.labelList)
+        bounds = np.linspace(0, n, shards + 1).astype(int)
+
+        jobs = [(self, i, bounds[i], bounds[i+1]) for i in range(shards)]
+        with mp.Pool(workers) as pool:
+            results = pool.map(_create_shard, jobs)
+        for _, summary in results:
+            self.stats.merge(summary)
+
+        # merge the per-shard image lists in shard order
+        with open(self.detList, 'w') as fnewList:
+            for i in range(shards):
+                part = self.detList + f'.{i}'
+                with open(part, 'r') as f:
+                    fnewList.write(f.read())
+                os.remove(part)
+        self.close_manifest()
+
+        print(f'[INFO] done creating dataset')
+        self.stats.report()
+
+    def create_shard(self, indices, fnewList, journal, part=0):
+        """
+        create dataset from the label files at indices, making the synthetic images of the
+        backgrounds picked among them, and append what is done to the manifest file journal.
+        Images completed by an earlier run, as loaded by open_manifest, are only listed.
+        With packed output, the samples go to the tar shards <packBase>-<part>-<n>.tar,
+        which are listed instead of the images
+        """
+        new_image = 0   # counter
+        self.writer = ThreadPoolExecutor(self.writers)
+        self.pending = deque()
+        self.journal = manifest.manifestWriter(journal, self.checkpoint)
+        self.pack = packShardWriter(f'{self.packBase}-{part:03d}', self.packCap) if self.packCap else None
+
+        for ind, kind in self.plan(indices):
+            imageName = self.image_path(self.pathLabel + self.labelList[ind])
             newLabel = self.detLabel + self.prefix + f'{ind}.txt'
- 
-            # object in image in target object list
-            for line in content:
-                items = line.split(' ')
-
-                if items[0] in self.target:
-                    _x, _y, _w, _h = float(items[1]), float(items[2]), float(items[3]), float(items[4])
-                    tx = _x - _w/2
-                    ty = _y - _h/2
-                    bx = _x + _w/2
-                    by = _y + _h/2
-
-                    # decrease the bbox if it steps outside the image
-                    while not (tx >= 0.0 and bx <= 1.0 and ty >= 0.0 and by <= 1.0):
-                        _w *= 0.95
-                        _h *= 0.95
-                        tx = _x - _w/2
-                        ty = _y - _h/2
-                        bx = _x + _w/2
-                        by = _y + _h/2
-
-                    fnewLabel = open(newLabel, 'a')
-                    items[0] = self.conversion[items[0]]
-                    items[3] = str(_w)
-                    items[4] = str(_h)
-                    newLine = " ".join(items)
-                    fnewLabel.write(newLine+'\n')
-                    fnewLabel.close()
-
-                    change = True # change flag
-
-            # object in image NOT in target object list
-            if not change and new_image < (self.dtSize - 1):
-                human = False # human flag
-                flabel = open(labelName, 'r')
-                content = flabel.read().split('\n')
-                # if human presents in image, pass
-                for line in content:
-                    items = line.split(' ')
-                    if items[0] == '0':
-                        human = True
-
-                if not human:
-                    imageName = labelName.split('labels')
-                    imageName = imageName[0] + 'images' + imageName[-1]
-                    imageName = imageName.split('.txt')
-                    imageName = imageName[0] + '.jpg'
-
-                    bg = mpimg.imread(imageName)
-                    if len(bg.shape) == 3:
-                        mask, coord = self.choose_mask(BBOX_TXT)
-                        ratio = np.random.rand()
-                        ratio *= 0.5
-                        ratio = np.clip(ratio, 0.1, 0.5)
-                        targetWidth = int(ratio * bg.shape[1])
-                        rot = np.random.randint(4) * 90
-                        resized, shape = self.process_mask(mask, coord, targetWidth, rot)
-                        resized = self.color_jitter(resized)
-                        resized = resized.astype(np.uint8)
-                        result, dim = self.add_mask(bg, resized)
-
-                        fnewLabel = open(newLabel, 'a')
-                        newLine = f'{len(self.target)} {dim[0]} {dim[1]} {dim[2]} {dim[3]}\n'
-                        fnewLabel.write(newLine)
-                        fnewLabel.close()
-
-                        new_image += 1
-            
-            if change or (not change and new_image < (self.dtSize-1) and not human):
-                newImage = self.detImage + self.prefix + f'{ind}.jpg'
-                if not change and new_image < (self.dtSize-1) and not human:
-                    result = cv2.cvtColor(result, cv2.COLOR_BGR2RGB)
-                    cv2.imwrite(newImage, result)
+            newImage = self.detImage + self.prefix + f'{ind}.jpg'
+
+            item = self.done.get(ind)
+            if item is not None and item['kind'] == kind and ind not in self.redo \
+                    and (item['image'] is None or os.path.exists(item['image'])):
+                # completed by an earlier run
+                if item['image'] is not None:
+                    fnewList.write(item['image'] + '\n')
+                new_image += kind == 'composite'
+                self.stats.count('resumed')
+                continue
+
+            if kind == 'passthrough':
+                # object in image in target object list
+                item = {'ind': int(ind), 'kind': kind, 'source': imageName, 'image': newImage, 'label': newLabel}
+                cls, xywh = self.target_labels(ind)
+                if self.outSize:
+                    # brought to the training resolution, so encoded again
+                    if self.is_color(imageName):
+                        img, xywh = self.fit_output(self.load_image(imageName), xywh)
+                        self.output_image(newImage, newLabel, img, cls, xywh, item, fnewList)
+                    else:
+                        self.stats.count('skipped_gray_passthrough')
+                        item['image'] = None
+                        self.journal.record(item)
+                    continue
+                if self.pack is not None:
+                    self.pack_passthrough(imageName, newImage, self.label_lines(cls, xywh), item)
+                    continue
+                self.write_labels(newLabel, cls, xywh)
+                written = self.passthrough(imageName, newImage)
+                if written:
                     fnewList.write(newImage + '\n')
-                elif change:
-                    imageName = labelName.split('labels')
-                    imageName = imageName[0] + 'images' + imageName[-1]
-                    imageName = imageName.split('.txt')
-                    imageName = imageName[0] + '.jpg'
-                    img = mpimg.imread(imageName)
-                    if len(img.shape) == 3:
-                        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                        cv2.imwrite(newImage, img)
-                        fnewList.write(newImage + '\n')
-            if ind % 100 == 0:    
+                else:
+                    item['image'] = None
+                self.journal.record(item)
+            else:
+                # object in image NOT in target object list
+                bg = self.load_image(imageName)
+                result, dims, masks = self.seeded(ind, self.seed).composite_image(bg)
+                result, dims = self.fit_output(result, dims)
+
+                item = {'ind': int(ind), 'kind': kind, 'source': imageName, 'image': newImage, 'label': newLabel,
+                        'seed': image_seed(self.seed, ind), 'masks': [self.maskKeys[m] for m in masks]}
+                self.output_image(newImage, newLabel, result, [len(self.target)] * len(dims), dims, item, fnewList)
+                new_image += 1
+
+        # wait for the background encodes
+        while self.pending:
+            self.wait_image()
+        self.writer.shutdown()
+        if self.pack is not None:
+            self.pack.close()
+            for path in self.pack.paths:
+                fnewList.write(path + '\n')
+        self.journal.close()
+        del self.writer, self.pending, self.journal, self.pack
+
+        return new_image
+
+    def open_manifest(self):
+        """
+        writes the manifest header and, when resuming, loads the images completed by the
+        last build into self.done, to be skipped
+
+        the last build is discarded if it was made with other settings. In incremental
+        mode the synthetic images made from masks that are gone from the bank or changed
+        are made again, together with a share of the others equal to the share of masks
+        added to the bank, so that the new masks show up
+        """
+        assert(not (self.resume and self.packCap)), 'Resume needs loose files, packed shards are written from scratch'
+        self.manifestPath = os.path.splitext(self.detList)[0] + '_manifest.jsonl'
+        header, records = manifest.read(self.manifestPath) if self.resume else (None, {})
+        if self.seed is None:
+            self.seed = header['config']['seed'] if header else int(self.rng.randint(2**31))
+        config = self.build_config()
+        if header is not None and header['config'] != config:
+            print('[INFO] settings changed since the last build, building from scratch')
+            header, records = None, {}
+
+        self.maskKeys = self.bank.keys()
+        self.redo = set()
+        if self.incremental and header is not None:
+            current = set(self.maskKeys)
+            share = len(current - set(header['masks'])) / max(len(current), 1)
+            rng = np.random.RandomState(self.seed)
+            for ind, item in sorted(records.items()):
+                if item['kind'] == 'composite':
+                    if any(key not in current for key in item['masks']) or rng.rand() < share:
+                        self.redo.add(ind)
+            print(f'[INFO] {len(self.redo)} synthetic images affected by the mask bank change')
+        self.done = records
+
+        # images to make again are left out, so they are made again after a crash too
+        kept = {ind: item for ind, item in records.items() if ind not in self.redo}
+        manifest.write(self.manifestPath, {'config': config, 'masks': self.maskKeys}, kept)
+        if records:
+            print(f'[INFO] resuming, {len(kept)} images done by the last build')
+
+    def close_manifest(self):
+        """merges the records appended by the last run into the manifest"""
+        header, records = manifest.read(self.manifestPath)
+        manifest.write(self.manifestPath, header, records)
+
+    def build_config(self):
+        """settings the images depend on, a build made with other settings is not resumed"""
+        return {'labels': self.pathLabel, 'target': self.target, 'prefix': self.prefix, 'seed': self.seed,
+                'objects': self.objects, 'maxIou': self.maxIou, 'rotation': self.rotation, 'flip': self.flip,
+                'shear': self.shear, 'feather': self.feather, 'passthrough': self.passMode,
+                'sampler': self.sampler, 'strata': self.strata, 'size': self.outSize, 'fit': self.fitMode,
+                'holdout': self.holdout,
+                'quality': self.encodeParams[1]}
+
+    def seeded(self, ind, seed):
+        """returns a shallow copy with the random state of image ind, so each synthetic image can be made on its own"""
+        worker = copy.copy(self)
+        worker.rng = np.random.RandomState(image_seed(seed, ind))
+
+        return worker
+
+    def plan(self, indices, verbose=True):
+        """
+        yields (ind, kind) for the images making up the dataset, in order
+
+            - passthrough: image with target objects, used as is
+            - composite: background for a synthetic image, picked by select_backgrounds
+        """
+        for ind in indices:
+            if self.hasTarget[ind]:
+                self.stats.count('passthrough')
+                yield ind, 'passthrough'
+            elif self.chosen[ind]:
+                self.stats.count('composite')
+                yield ind, 'composite'
+            if verbose and ind % 100 == 0:
                 print(f'[INFO] {ind} of {len(self.labelList)} processed')
-        
-        print(f'[INFO] done creating dataset')
-        fnewList.close()
-            
+            self.stats.step(ind, len(self.labelList))
+
+    def select_backgrounds(self, seed):
+        """
+        picks the dtSize backgrounds of the synthetic images up front into self.chosen,
+        among the color images without target objects or humans (class 0). Candidates are
+        walked in the order of the sampler and only their JPEG header is read, until the
+        budget is met
+
+            - random: uniformly at random
+            - stratified: in proportion to the candidates in each of self.strata bins of
+                          image area, the largest images in the last bin
+            - first: in label file order
+        """
+        candidates = np.flatnonzero(~self.hasTarget & ~self.human)
+        self.stats.count('skipped_human', int(np.count_nonzero(~self.hasTarget & self.human)))
+        rng = np.random.RandomState(seed)
+        budget = self.dtSize
+
+        if self.sampler == 'first':
+            groups, quotas = [candidates], [budget]
+        elif self.sampler == 'random':
+            groups, quotas = [rng.permutation(candidates)], [budget]
+        else:
+            area = np.zeros(len(candidates))
+            for i, ind in enumerate(candidates):
+                header = util.jpeg_header(self.image_path(self.pathLabel + self.labelList[ind]))
+                if header is not None:
+                    area[i] = header[0] * header[1]
+            edges = np.quantile(area, np.linspace(0, 1, self.strata + 1)[1:-1]) if len(area) else []
+            bins = np.searchsorted(edges, area, side='right')
+            groups = [rng.permutation(candidates[bins == b]) for b in range(self.strata)]
+
+            # largest remainder split of the budget
+            share = budget * np.array([len(g) for g in groups]) / max(len(candidates), 1)
+            quotas = np.floor(share).astype(int)
+            quotas[np.argsort(quotas - share)[:budget - quotas.sum()]] += 1
+
+        self.chosen = np.zeros(len(self.labelList), dtype=bool)
+        walked = [0] * len(groups)
+        taken = 0
+
+        def take(g, quota):
+            nonlocal taken
+            group = groups[g]
+            while quota > 0 and taken < budget and walked[g] < len(group):
+                ind = group[walked[g]]
+                walked[g] += 1
+                if self.is_color(self.image_path(self.pathLabel + self.labelList[ind])):
+                    self.chosen[ind] = True
+                    taken += 1
+                    quota -= 1
+                else:
+                    self.stats.count('skipped_gray')
+
+        for g, quota in enumerate(quotas):
+            take(g, quota)
+        # bins short of color images leave their share to the others
+        for g in range(len(groups)):
+            take(g, budget)
+
+        print(f'[INFO] {taken} of {budget} backgrounds picked ({self.sampler}) from {len(candidates)} candidates')
+        return self.chosen
+
+    def target_labels(self, ind):
+        """returns the converted class ids and clamped boxes of the target objects of an image"""
+        sl = slice(self.index.start[ind], self.index.start[ind+1])
+        keep = self.labelKeep[sl]
+
+        return self.labelCls[sl][keep], self.labelXYWH[sl][keep]
+
+    def stream(self, prefetch=8, workers=4, seed=None):
+        """
+        yields (image, labels) straight from the compositing path, without writing to disk
+
+        the images are the same ones create() would write, picked by the same rules, and
+        prepared on background threads at most prefetch images ahead of the consumer.
+        Each synthetic image has its own random state derived from seed and its index,
+        so the stream does not depend on the number of threads.
+
+        image is a BGR uint8 array, labels an (n, 5) float array of YOLO class, x, y, w, h
+        """
+        self.transform_labels()
+        if seed is None:
+            seed = self.rng.randint(2**31)
+        self.select_backgrounds(seed)
+
+        pool = ThreadPoolExecutor(workers)
+        pending = deque()
+        try:
+            for ind, kind in self.plan(range(len(self.labelList)), verbose=False):
+                pending.append(pool.submit(self.sample, ind, kind, seed))
+                while len(pending) >= prefetch:
+                    item = pending.popleft().result()
+                    if item is not None:
+                        yield item
+            while pending:
+                item = pending.popleft().result()
+                if item is not None:
+                    yield item
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+    def sample(self, ind, kind, seed):
+        """returns (image, labels) of one image planned by plan, None if it is skipped"""
+        imageName = self.image_path(self.pathLabel + self.labelList[ind])
+        if kind == 'passthrough':
+            if not self.is_color(imageName):
+                return None
+            cls, xywh = self.target_labels(ind)
+            img, xywh = self.fit_output(self.load_image(imageName), xywh)
+            return img, np.column_stack([cls, xywh]).astype(np.float64)
+
+        # own random state so threads do not share one
+        result, dims, _ = self.seeded(ind, seed).composite_image(self.load_image(imageName))
+        result, dims = self.fit_output(result, dims)
+        labels = np.zeros((len(dims), 5))
+        labels[:, 0] = len(self.target)
+        if len(dims):
+            labels[:, 1:] = dims
+
+        return result, labels
+
+    def image_path(self, labelName):
+        """returns the image file of a label file"""
+        imageName = labelName.split('labels')
+        imageName = imageName[0] + 'images' + imageName[-1]
+        imageName = imageName.split('.txt')
+
+        return imageName[0] + '.jpg'
+
+    @instrument.timed('decode')
+    def load_image(self, imageName):
+        """decodes a BGR image, scaled to fit the output size if set"""
+        if self.outSize:
+            return resolution.load(imageName, self.outSize, self.fitMode)
+        return imgio.imread(imageName)
+
+    def fit_output(self, img, xywh):
+        """pads an image decoded by load_image to the output size and maps its YOLO boxes, if set"""
+        if self.outSize:
+            return resolution.letterbox(img, xywh, self.outSize, self.fitMode)
+        return img, xywh
+
+    @instrument.timed('header')
+    def is_color(self, imageName):
+        """checks for a 3-channel image from the JPEG header, decoding only non-JPEG files"""
+        return imgio.is_color(imageName)
+
+    @instrument.timed('passthrough')
+    def passthrough(self, imageName, newImage):
+        """
+        puts an unmodified color image at its destination without re-encoding it and
+        returns whether it was written. Grayscale images are skipped
+        """
+        if not self.is_color(imageName):
+            self.stats.count('skipped_gray_passthrough')
+            return False
+
+        if os.path.lexists(newImage):
+            os.remove(newImage)
+        if self.passMode == 'encode':
+            cv2.imwrite(newImage, imgio.imread(imageName), self.encodeParams)
+        elif self.passMode == 'hardlink':
+            try:
+                os.link(imageName, newImage)
+            except OSError:
+                shutil.copyfile(imageName, newImage)
+        elif self.passMode == 'reflink':
+            util.reflink(imageName, newImage)
+        else:
+            shutil.copyfile(imageName, newImage)
+
+        return True
+
+    def pack_passthrough(self, imageName, newImage, label, item):
+        """
+        reads an unmodified color image on the background writer pool, to be appended to
+        the packed shard with its label lines in turn with the synthetic images.
+        Grayscale images are skipped
+        """
+        if not self.is_color(imageName):
+            self.stats.count('skipped_gray_passthrough')
+            item['image'] = None
+            self.journal.record(item)
+            return
+        self.queue(self.writer.submit(self.read_image, imageName), newImage, item, label)
+
+    @instrument.timed('passthrough')
+    def read_image(self, imageName):
+        """returns the JPEG bytes of an unmodified image, re-encoded in 'encode' passthrough mode"""
+        if self.passMode == 'encode':
+            return cv2.imencode('.jpg', imgio.imread(imageName), self.encodeParams)[1]
+        with open(imageName, 'rb') as f:
+            return f.read()
+
+    def output_image(self, newImage, newLabel, img, cls, xywh, item, fnewList):
+        """writes an image to encode and its labels and lists it, or packs them"""
+        if self.pack is not None:
+            self.write_image(newImage, img, item, self.label_lines(cls, xywh))
+        else:
+            self.write_labels(newLabel, cls, xywh)
+            self.write_image(newImage, img, item)
+            fnewList.write(newImage + '\n')
+
+    def write_image(self, newImage, img, item=None, label=None):
+        """
+        encodes a BGR image on the background writer pool, recording item in the manifest
+        once written. With packed output, it is appended to the shard with its label lines
+        """
+        if self.pack is None:
+            self.queue(self.writer.submit(self.imwrite, newImage, img), newImage, item)
+        else:
+            self.queue(self.writer.submit(self.imencode, img), newImage, item, label)
+
+    def queue(self, future, newImage, item, label=None):
+        # bound the number of images waiting to be encoded
+        while len(self.pending) >= 2 * self.writers:
+            self.wait_image()
+        self.pending.append((future, newImage, item, label))
+
+    def wait_image(self):
+        """waits for the oldest image being encoded, and appends it to the packed shard in order"""
+        future, newImage, item, label = self.pending.popleft()
+        buf = future.result()
+        if self.pack is not None:
+            key = os.path.splitext(os.path.basename(newImage))[0]
+            with self.stats.stage('pack'):
+                path = self.pack.add(key, buf, label)
+            if item is not None:
+                item['image'], item['label'] = f'{path}:{key}.jpg', f'{path}:{key}.txt'
+        if item is not None:
+            self.journal.record(item)
+
+    @instrument.timed('imwrite')
+    def imwrite(self, newImage, img):
+        """
+        encodes and writes an image, on a writer thread. A hard link left by an earlier
+        passthrough run is removed first, so its source image is not written through
+        """
+        if os.path.lexists(newImage):
+            os.remove(newImage)
+        return cv2.imwrite(newImage, img, self.encodeParams)
+
+    @instrument.timed('imwrite')
+    def imencode(self, img):
+        """encodes an image to JPEG bytes, on a writer thread"""
+        return cv2.imencode('.jpg', img, self.encodeParams)[1]
+
+    def transform_labels(self):
+        """
+        clamps and converts the boxes of the whole label index at once
+
+        boxes of target objects stepping outside the image are shrunk by 0.95 steps
+        (see util.shrink_boxes for the tolerance) and their class ids are converted
+        through the conversion table. Boxes centered on or outside the image border,
+        which can never fit, are dropped from the labels.
+        """
+        cls = self.index.cls
+        lut = self.conversionLut
+        converted = np.full(len(cls), -1)
+        known = cls < len(lut)
+        converted[known] = lut[cls[known]]
+
+        xywh, valid = util.shrink_boxes(self.index.xywh)
+        self.labelKeep = (converted >= 0) & valid
+        self.labelCls = converted
+        self.labelXYWH = xywh
+        self.hasTarget = np.bincount(self.index.fileId[converted >= 0], minlength=len(self.labelList)) > 0
+
+    def label_lines(self, cls, xywh):
+        """returns the YOLO label lines of an image"""
+        lines = [f'{c} {x} {y} {w} {h}\n' for c, (x, y, w, h) in zip(np.asarray(cls).tolist(), np.asarray(xywh).tolist())]
+        return ''.join(lines)
+
+    @instrument.timed('write_labels')
+    def write_labels(self, labelName, cls, xywh):
+        """writes all the YOLO label lines of an image at once"""
+        with open(labelName, 'w') as f:
+            f.write(self.label_lines(cls, xywh))
+
     def load_labels(self, pathLabel):
-        """load labels as list"""
+        """load labels as list, through the cached label index"""
         self.pathLabel = pathLabel
-        self.labelList = os.listdir(pathLabel)
+        self.index = labelIndex(pathLabel)
+        self.labelList = list(self.index.names)
+        self.human = self.index.has_class(0)
     
-    def process_mask(self, maskFile, coordList, targetWidth, rot):
-        """crops the area outside bbox of mask and rotate"""
-        img = mpimg.imread(maskFile)
-
-        topx = int(coordList[0])
-        topy = int(coordList[1])
-        botx = int(coordList[2])
-        boty = int(coordList[3])
-
-        sliced = img[topy:boty, topx:botx, :]
-        rotated = util.rotate_bound(sliced, rot)
-        resized = util.resize_img(rotated, targetWidth)
-
-        return resized, resized.shape
+    @instrument.timed('process_mask')
+    def transform_mask(self, sliced, targetWidth, rot, alpha=None, flip=False, shear=0.0):
+        """
+        rotates, flips, shears and resizes a mask already cropped to its bbox with a single
+        resample, and returns it with its alpha, both cropped tight to the transformed alpha.
+        The bounding box of the rotated mask is targetWidth wide before the tight crop
+        """
+        if alpha is None:
+            alpha = composite.blend_alpha(sliced)
+        h, w = sliced.shape[:2]
+        scale = transform.fit_scale(w, h, targetWidth, rot, flip, shear)
+
+        return transform.warp(sliced, alpha, rot, scale, flip, shear)
+
+    def random_transform(self):
+        """draws the rotation, flip and shear of a mask"""
+        if self.rotation == 'any':
+            rot = self.rng.uniform(0, 360)
+        else:
+            rot = self.rng.randint(4) * 90
+        flip = self.flip > 0 and self.rng.rand() < self.flip
+        shear = self.rng.uniform(-self.shear, self.shear) if self.shear > 0 else 0.0
+
+        return rot, flip, shear
+
+    def set_bank(self, bboxFile, budget=512*2**20):
+        """load the mask bbox file as an in-memory mask bank"""
+        self.bank = maskBank(bboxFile, budget)
+
+    def set_holdout(self, split, share=0.2, block=16):
+        """
+        paste only the masks of split, 'train' or 'test', of the bank split by maskBank.split,
+        so that no mask of the test set shows up in the train set and the other way around
+
+        args:
+            split: 'train' or 'test'
+            share: share of the masks held out for the test set
+            block: number of consecutive masks held out together
+        """
+        assert(split in ['train', 'test']), 'Split should be either \'train\' or \'test\''
+        train, test = self.bank.split(share, block)
+        self.bank = self.bank.subset(train if split == 'train' else test)
+        self.holdout = [split, share, block]
+        print(f'[INFO] {len(self.bank.active)} of {len(self.bank)} masks kept for the {split} set')
 
     def set_dest(self, mode, dest, prefix):
         """set up dir structure at destination folder"""
@@ -250,6 +696,7 @@ class createDataset(object):
             self.detImage = dest+'images/'+'test/'
             self.detLabel = dest+'labels/'+'test/'
             self.detList = dest+'test.txt'
+        self.packBase = dest+'shards/'+mode
         self.prefix = prefix
 
     def set_target(self, target):
@@ -265,27 +712,199 @@ class createDataset(object):
         self.conversion = {}
         for i, cat in enumerate(self.target):
             self.conversion[cat] = f'{i}'
+
+        # same table as an array lookup, -1 for the other classes
+        self.conversionLut = np.full(max(int(cat) for cat in self.target) + 1, -1)
+        for cat, new in self.conversion.items():
+            self.conversionLut[int(cat)] = int(new)
     
+    def set_output(self, passthrough='copy', quality=95, writers=4, pack=0):
+        """
+        set how images are written
+
+        args:
+            passthrough: how unmodified images are put at the destination,
+                         'copy', 'hardlink', 'reflink' or 'encode' (decode and re-encode)
+            quality: JPEG quality of the encoded images
+            writers: number of background threads encoding the composited images
+            pack: size cap in MB of the tar shards the images and labels are packed into,
+                  see packShard. 0 writes loose files
+        """
+        assert(passthrough in ['copy', 'hardlink', 'reflink', 'encode']), 'Passthrough should be one of the followings: \'copy\', \'hardlink\', \'reflink\', \'encode\''
+        self.passMode = passthrough
+        self.encodeParams = [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+        self.writers = writers
+        self.packCap = int(pack * 2**20)
+
+    def set_resolution(self, size=0, mode='letterbox'):
+        """
+        set the resolution of the output images, see resolution
+
+        args:
+            size: side of the square images the trainer takes, e.g. 416 or 608. 0 keeps
+                  the resolution of the sources and passes the target images through
+            mode: 'letterbox' to scale to fit and pad, keeping the aspect, or 'resize' to stretch
+        """
+        assert(mode in ['letterbox', 'resize']), 'Mode should be either \'letterbox\' or \'resize\''
+        self.outSize = size
+        self.fitMode = mode
+
+    def set_augment(self, rotation='right', flip=0.0, shear=0.0):
+        """
+        set the geometric augmentation of the masks
+
+        args:
+            rotation: 'right' for multiples of 90 degrees, 'any' for any angle
+            flip: probability of flipping a mask horizontally
+            shear: max shear along x in degrees
+        """
+        assert(rotation in ['right', 'any']), 'Rotation should be either \'right\' or \'any\''
+        self.rotation = rotation
+        self.flip = flip
+        self.shear = shear
+
+    def set_objects(self, objects=1, maxIou=0.1):
+        """
+        set number of masks pasted per background
+
+        args:
+            objects: masks per background. With more than one, the masks are placed on
+                     the positions left free by the masks already pasted
+            maxIou: max IoU between the boxes of two masks of the same background
+        """
+        self.objects = objects
+        self.maxIou = maxIou
+
+    def set_feather(self, feather):
+        """set sigma in pixels of the edge feathering of the pasted masks, 0 for hard edges"""
+        self.feather = feather
+
+    def set_seed(self, seed):
+        """use a private random state instead of the global one"""
+        self.rng = np.random.RandomState(seed)
+        self.seed = seed
+
+    def set_sampler(self, sampler='random', strata=4):
+        """
+        set how the backgrounds of the synthetic images are picked, see select_backgrounds
+
+        args:
+            sampler: 'random', 'stratified' by image area or 'first' in label file order
+            strata: number of image area bins of the stratified sampler
+        """
+        assert(sampler in ['random', 'stratified', 'first']), 'Sampler should be one of the followings: \'random\', \'stratified\', \'first\''
+        self.sampler = sampler
+        self.strata = strata
+
+    def set_manifest(self, resume=False, incremental=False, checkpoint=100):
+        """
+        set how the build manifest is used
+
+        args:
+            resume: skip the images completed by the last build with the same settings
+            incremental: also make again the synthetic images affected by a change of the
+                         mask bank since the last build. Implies resume
+            checkpoint: images between two flushes of the manifest to disk
+        """
+        self.resume = resume or incremental
+        self.incremental = incremental
+        self.checkpoint = checkpoint
+
     def set_size(self, size):
         """set number of custom object"""
         self.dtSize = size
+
+    def set_stats(self, log=None, every=100, profile=None, name=''):
+        """
+        set the instrumentation of create
+
+        args:
+            log: file to append JSON progress lines and the summary to, '-' for stdout
+            every: emit a progress line every n label files
+            profile: file to dump the cProfile stats of the run to, of the first shard
+                     only in parallel mode
+            name: name of the run in the JSON lines
+        """
+        self.stats = instrument.stageStats(name, log, every)
+        self.profile = profile
+
+
+def image_seed(seed, ind):
+    """seed of the synthetic image made from background ind"""
+    return int(np.random.SeedSequence([seed, int(ind)]).generate_state(1)[0])
+
+def _create_shard(job):
+    """creates one shard of the dataset in a worker process"""
+    c, shard, start, stop = job
+    c.stats.reset()
+    c.stats.name += f'/{shard}'
+    journal = c.manifestPath + f'.{shard}'
+    with open(c.detList + f'.{shard}', 'w') as fnewList:
+        if shard == 0 and c.profile:
+            count = instrument.profiled(c.profile, c.create_shard, range(start, stop), fnewList, journal, shard)
+        else:
+            count = c.create_shard(range(start, stop), fnewList, journal, shard)
+
+    return count, c.stats.summary()
        
+def configure(c, info):
+    """sets up the mask bank and the output from the optional cfg keys"""
+    c.set_bank(info.get('MASK_SHARD') or info['BBOX_TXT'], int(info.get('MASK_CACHE_MB', 512))*2**20)
+    c.set_output(info.get('PASSTHROUGH', 'copy'), int(info.get('JPEG_QUALITY', 95)), int(info.get('WRITERS', 4)),
+                 float(info.get('PACK_MB', 0)))
+    c.set_feather(float(info.get('FEATHER', 0)))
+    c.set_augment(info.get('ROTATION', 'right'), float(info.get('FLIP', 0)), float(info.get('SHEAR', 0)))
+    c.set_objects(int(info.get('OBJECTS', 1)), float(info.get('MAX_IOU', 0.1)))
+    c.set_sampler(info.get('SAMPLER', 'random'), int(info.get('STRATA', 4)))
+    c.set_resolution(int(info.get('OUT_SIZE', 0)), info.get('OUT_FIT', 'letterbox'))
+
+def hold_out(c, info, split):
+    """keeps only the masks of split if TEST_MASKS is set in the cfg, see set_holdout"""
+    share = float(info.get('TEST_MASKS', 0))
+    if share > 0:
+        c.set_holdout(split, share, int(info.get('MASK_BLOCK', 16)))
+
+def run(c, args):
+    """runs create serially or in worker processes"""
+    c.set_stats(args['stats'], args['every'], args['profile'], args['mode'])
+    c.set_manifest(args['resume'], args['incremental'], args['checkpoint'])
+    if args['seed'] is not None:
+        c.set_seed(args['seed'])
+    if args['workers'] > 0:
+        c.create_parallel(args['workers'], args['shards'])
+    else:
+        if args['profile']:
+            instrument.profiled(args['profile'], c.create)
+        else:
+            c.create()
 
 def main():
     """
     Mode:
         - train:    create train dataset
         - test:     create test dataset
+        - all:      create train and test datasets in one run, sharing the mask bank,
+                    with disjoint masks
         - count:    count the number of images of objects of interest
     """
     # parse arguments
     ap = argparse.ArgumentParser(description='Generate Custom Object Dataset From Mask.')
-    ap.add_argument('-m', '--mode', required=True, help='train, test or count')
+    ap.add_argument('-m', '--mode', required=True, help='train, test, all or count')
+    ap.add_argument('--split', default='train', help='dataset to count in count mode, train or test')
     ap.add_argument('-c', '--cfg', required=True, help='path to cfg file')
+    ap.add_argument('-w', '--workers', type=int, default=0, help='number of worker processes. 0 runs serially')
+    ap.add_argument('-s', '--shards', type=int, default=None, help='number of shards for parallel mode (default: workers)')
+    ap.add_argument('--seed', type=int, default=None, help='random seed (default: from the manifest when resuming, random otherwise)')
+    ap.add_argument('--resume', action='store_true', help='skip the images completed by the last build')
+    ap.add_argument('--incremental', action='store_true', help='resume, making again the synthetic images affected by mask bank changes')
+    ap.add_argument('--checkpoint', type=int, default=100, help='images between two flushes of the manifest')
+    ap.add_argument('--stats', default=None, help='file to append JSON progress lines and the summary to, - for stdout')
+    ap.add_argument('--every', type=int, default=100, help='label files between two progress lines')
+    ap.add_argument('--profile', default=None, help='file to dump cProfile stats to, of the first shard in parallel mode')
     args = vars(ap.parse_args())
 
     # mode assertion
-    assert(args['mode'] in ['train', 'test', 'count']), 'Mode should be one of the followings: \'train\', \'test\', \'count\''
+    assert(args['mode'] in ['train', 'test', 'all', 'count']), 'Mode should be one of the followings: \'train\', \'test\', \'all\', \'count\''
 
     # parse configuration file and set constants
     info = util.parse_cfg(args['cfg'])
@@ -294,27 +913,54 @@ def main():
     
     # main body
     mode = args['mode']
+    sizes = {'train': int(info.get('TRAIN_SIZE', 6000)), 'test': int(info.get('TEST_SIZE', 2000))}
     if mode == 'train':
         c = createDataset()
         c.set_target(TARGET)
-        c.set_size(6000)
+        c.set_size(sizes[mode])
+        configure(c, info)
+        hold_out(c, info, mode)
         c.load_labels(TRAIN_LABEL)
         c.set_dest(mode, DET, 'COCO_2014_train')
-        c.create()
+        run(c, args)
 
     elif mode == 'test':
         c = createDataset()
         c.set_target(TARGET)
-        c.set_size(2000)
+        c.set_size(sizes[mode])
+        configure(c, info)
+        hold_out(c, info, mode)
         c.load_labels(VAL_LABEL)
         c.set_dest(mode, DET, 'COCO_2014_test')
-        c.create()
+        run(c, args)
+
+    elif mode == 'all':
+        # masks are held out for the test set unless TEST_MASKS says otherwise
+        info.setdefault('TEST_MASKS', '0.2')
+        assert(float(info['TEST_MASKS']) > 0), 'TEST_MASKS should be over 0 in all mode, to keep the masks of the splits apart'
+
+        # cfg, targets and mask bank set up once for both splits
+        base = createDataset()
+        base.set_target(TARGET)
+        configure(base, info)
+        for split, label, prefix in [('train', TRAIN_LABEL, 'COCO_2014_train'), ('test', VAL_LABEL, 'COCO_2014_test')]:
+            print(f'[INFO] creating {split} dataset')
+            c = copy.copy(base)
+            c.set_size(sizes[split])
+            hold_out(c, info, split)
+            c.load_labels(label)
+            c.set_dest(split, DET, prefix)
+            profile = None
+            if args['profile']:
+                root, ext = os.path.splitext(args['profile'])
+                profile = f'{root}_{split}{ext}'
+            run(c, dict(args, mode=split, profile=profile))
     
     else: 
-        which = input('Which dataset? train or test? > ')
-       
+        which = args['split']
+
         # input assertion
-        assert(which in ['train', 'test']), 'Try again with right input'
+        assert(which in ['train', 'test']), 'Split should be either \'train\' or \'test\''
 
         # set right label for each category
         if which == 'train':
@@ -0,0 +1,23 @@
+"""
+This script contains the image decoding of yoloMask and createDataset, through OpenCV only.
+Images are BGR uint8 from decode to encode, like the video frames and the mask shard, so no
+RGB/BGR conversion is made along the way. matplotlib is only loaded by vis, to show images.
+"""
+import cv2
+import util
+
+def imread(path, flags=cv2.IMREAD_COLOR):
+    """decodes an image file to a BGR uint8 array, raising an error if it can't be read"""
+    img = cv2.imread(path, flags)
+    if img is None:
+        raise IOError(f'cannot read image {path}')
+
+    return img
+
+def is_color(path):
+    """checks for a 3-channel image from the JPEG header, decoding only non-JPEG files"""
+    header = util.jpeg_header(path)
+    if header is not None:
+        return header[2] == 3
+
+    return imread(path, cv2.IMREAD_UNCHANGED).ndim == 3
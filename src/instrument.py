@@ -0,0 +1,131 @@
+"""
+This script contains the instrumentation of yoloMask and createDataset. Every stage records its
+number of calls and wall time, and counters record events such as skipped images. Progress and
+the final summary are emitted as JSON lines, one object per line, so a run can be followed with
+tail -f and parsed with jq.
+
+    {"event": "progress", "run": "train", "time": 12.3, "done": 400, "total": 82783, ...}
+    {"event": "summary", "run": "train", "time": 2410.8, "stages": {...}, "counts": {...}}
+"""
+import cProfile
+from contextlib import contextmanager
+import functools
+import json
+import threading
+import time
+
+class stageStats(object):
+    def __init__(self, name='', log=None, every=100):
+        """
+        args:
+            name: name of the run, added to every line
+            log: file to append the JSON lines to, '-' for stdout, None for no lines
+            every: emit a progress line every n steps
+        """
+        self.name = name
+        self.log = log
+        self.every = every
+        self.lock = threading.Lock()
+        self.reset()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def reset(self):
+        """clears the stages and counters and restarts the clock"""
+        self.start = time.perf_counter()
+        self.seconds = {}
+        self.calls = {}
+        self.counts = {}
+
+    @contextmanager
+    def stage(self, name):
+        """times the body of the with statement as one call of stage name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds, calls=1):
+        with self.lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + calls
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def step(self, done, total=None, **fields):
+        """marks progress, emitting a progress line every self.every steps"""
+        if self.log is not None and done % self.every == 0:
+            self.emit('progress', done=done, total=total, counts=dict(self.counts), **fields)
+
+    def summary(self):
+        """returns the stages and counters recorded so far as a dict"""
+        with self.lock:
+            stages = {name: {'calls': self.calls[name], 'seconds': sec,
+                             'ms_per_call': 1000 * sec / self.calls[name]}
+                      for name, sec in self.seconds.items()}
+            return {'elapsed': time.perf_counter() - self.start, 'stages': stages, 'counts': dict(self.counts)}
+
+    def drain(self):
+        """returns the summary and clears it, to send the stats of a worker process along with its results"""
+        res = self.summary()
+        with self.lock:
+            self.seconds, self.calls, self.counts = {}, {}, {}
+        return res
+
+    def merge(self, summary):
+        """adds the stages and counters of a summary, e.g. from a worker process"""
+        for name, item in summary['stages'].items():
+            self.add(name, item['seconds'], item['calls'])
+        for name, n in summary['counts'].items():
+            self.count(name, n)
+
+    def emit(self, event, **fields):
+        line = json.dumps({'event': event, 'run': self.name,
+                           'time': round(time.perf_counter() - self.start, 3), **fields})
+        if self.log == '-':
+            print(line, flush=True)
+        else:
+            # a single write per line, so lines of worker processes do not interleave
+            with open(self.log, 'a') as f:
+                f.write(line + '\n')
+
+    def report(self):
+        """prints the stage times and counters, and emits the summary line"""
+        res = self.summary()
+        for name, item in sorted(res['stages'].items(), key=lambda kv: -kv[1]['seconds']):
+            print(f'[STATS] {name}: {item["calls"]} calls, {item["seconds"]:.2f} s, {item["ms_per_call"]:.3f} ms/call')
+        if res['counts']:
+            print('[STATS] ' + ', '.join(f'{k} {v}' for k, v in sorted(res['counts'].items())))
+        if self.log is not None:
+            self.emit('summary', **res)
+
+        return res
+
+def timed(name):
+    """decorates a method so its calls are recorded as stage name of self.stats"""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def timed_fn(self, *args, **kwargs):
+            with self.stats.stage(name):
+                return fn(self, *args, **kwargs)
+        return timed_fn
+    return wrap
+
+def profiled(path, fn, *args, **kwargs):
+    """runs fn under cProfile and dumps the stats to path, to be read with pstats or snakeviz"""
+    prof = cProfile.Profile()
+    try:
+        return prof.runcall(fn, *args, **kwargs)
+    finally:
+        prof.dump_stats(path)
+        print(f'[INFO] profile written to {path}')
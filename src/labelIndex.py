@@ -0,0 +1,104 @@
+"""
+This script contains the label index used by createDataset. All label files of a directory are
+scanned once into NumPy arrays and cached on disk under data/index. The cache is rebuilt when the
+mtime or size of the label directory changes.
+
+    names:  label file names, sorted
+    start:  boxes of file i are start[i]:start[i+1]
+    fileId: file of each box
+    cls:    class id of each box
+    xywh:   YOLO x, y, w, h of each box
+"""
+import hashlib
+import numpy as np
+import os
+
+class labelIndex(object):
+    def __init__(self, pathLabel, cacheDir=None):
+        """
+        args:
+            pathLabel: directory of YOLO label files
+            cacheDir: where the index is cached, data/index of the repo by default
+        """
+        if cacheDir is None:
+            cacheDir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data', 'index'))
+        self.pathLabel = pathLabel
+        self.cacheDir = cacheDir
+        self.load()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getstate__(self):
+        # worker processes read the arrays back from the cache
+        return {'pathLabel': self.pathLabel, 'cacheDir': self.cacheDir}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.load()
+
+    def cache_file(self):
+        key = hashlib.md5(os.path.abspath(self.pathLabel).encode()).hexdigest()
+        return os.path.join(self.cacheDir, f'{key}.npz')
+
+    def stamp(self):
+        """mtime and size of the label directory"""
+        st = os.stat(self.pathLabel)
+        return np.array([st.st_mtime_ns, st.st_size], dtype=np.int64)
+
+    def load(self):
+        """loads the index from the cache, scanning the label files if it is stale"""
+        stamp = self.stamp()
+        cache = self.cache_file()
+        if os.path.exists(cache):
+            with np.load(cache) as data:
+                if np.array_equal(data['stamp'], stamp):
+                    for key in ['names', 'start', 'fileId', 'cls', 'xywh']:
+                        setattr(self, key, data[key])
+                    return
+
+        self.build()
+        os.makedirs(self.cacheDir, exist_ok=True)
+        tmp = cache + '.tmp.npz'
+        np.savez(tmp, stamp=stamp, names=self.names, start=self.start,
+                 fileId=self.fileId, cls=self.cls, xywh=self.xywh)
+        os.replace(tmp, cache)
+
+    def build(self):
+        """scans all the label files"""
+        names = sorted(os.listdir(self.pathLabel))
+        start = [0]
+        cls = []
+        xywh = []
+        for ind, name in enumerate(names):
+            with open(os.path.join(self.pathLabel, name), 'r') as f:
+                content = f.read().split('\n')
+            for line in content:
+                items = line.split()
+                if len(items) < 5:
+                    continue
+                cls.append(int(items[0]))
+                xywh.append([float(v) for v in items[1:5]])
+            start.append(len(cls))
+            if ind % 1000 == 0:
+                print(f'[INDEX] {ind} of {len(names)} label files scanned')
+
+        self.names = np.array(names, dtype=str)
+        self.start = np.array(start, dtype=np.int64)
+        self.fileId = np.repeat(np.arange(len(names), dtype=np.int32), np.diff(self.start))
+        self.cls = np.array(cls, dtype=np.int32)
+        self.xywh = np.array(xywh, dtype=np.float64).reshape(-1, 4)
+
+    def boxes(self, ind):
+        """returns the class ids and x, y, w, h of the boxes of file ind"""
+        sl = slice(self.start[ind], self.start[ind+1])
+        return self.cls[sl], self.xywh[sl]
+
+    def has_class(self, cls):
+        """returns a flag per file telling whether it contains class cls"""
+        return np.bincount(self.fileId[self.cls == cls], minlength=len(self.names)) > 0
+
+    def count(self, classes):
+        """returns the number of boxes of each class in classes"""
+        counts = np.bincount(self.cls, minlength=max(classes) + 1)
+        return {cls: int(counts[cls]) for cls in classes}
@@ -0,0 +1,87 @@
+"""
+This script contains the build manifest of createDataset. Every image/label pair put in the
+dataset is recorded as one JSON line with its source image, the masks pasted on it and its
+random seed, so an interrupted run can be resumed and a changed mask bank rebuilt incrementally.
+
+    {"config": {...}, "masks": [...]}        header: settings of the build and keys of its mask bank
+    {"ind": 12, "kind": "composite", "source": ".../COCO_train2014_000000000012.jpg",
+     "image": ".../COCO_2014_train12.jpg", "label": ".../COCO_2014_train12.txt",
+     "seed": 1873622140, "masks": ["..."]}
+
+Records are appended and flushed to disk every few images. Worker processes append to their own
+part file, <manifest>.<shard>, which is merged into the manifest once the run is over.
+"""
+import glob
+import json
+import os
+
+def parts(path):
+    """returns the part files of a manifest"""
+    return sorted(glob.glob(glob.escape(path) + '.*[0-9]'))
+
+def read(path):
+    """
+    returns the header and the records of a manifest and its part files, by image index,
+    the later record of an image winning. A line cut short by a crash is ignored.
+    The header is None if there is no manifest
+    """
+    header = None
+    records = {}
+    for name in [path] + parts(path):
+        if not os.path.exists(name):
+            continue
+        with open(name, 'r') as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    continue
+                if 'config' in item:
+                    header = item
+                else:
+                    records[item['ind']] = item
+
+    return header, records
+
+def write(path, header, records):
+    """writes a whole manifest at once, replacing it and its part files"""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(json.dumps(header) + '\n')
+        for ind in sorted(records):
+            f.write(json.dumps(records[ind]) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    for name in parts(path):
+        os.remove(name)
+
+class manifestWriter(object):
+    def __init__(self, path, every=100):
+        """
+        appends records to a manifest
+
+        args:
+            path: manifest or part file
+            every: records between two checkpoints, flushed to disk
+        """
+        self.path = path
+        self.every = every
+        self.pending = 0
+        self.f = open(path, 'a')
+
+    def record(self, item):
+        self.f.write(json.dumps(item) + '\n')
+        self.pending += 1
+        if self.pending >= self.every:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """makes the records written so far survive a crash"""
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.pending = 0
+
+    def close(self):
+        self.checkpoint()
+        self.f.close()
@@ -0,0 +1,150 @@
+"""
+This script contains the mask bank used by createDataset. The bbox file is parsed once and the
+masks, already cropped to their bbox, are kept decoded in memory within a byte budget. A mask
+shard written by yoloMask.py can be used instead of the bbox file, in which case the crops are
+decoded from the memory-mapped shard into the same cache.
+"""
+from collections import OrderedDict
+import composite
+import copy
+import imgio
+import numpy as np
+import os
+import threading
+import util
+from maskShard import maskShard
+
+class maskBank(object):
+    def __init__(self, bboxFile, budget=512*2**20):
+        """
+        args:
+            bboxFile: mask bbox file or mask shard written by yoloMask.py
+            budget: max number of bytes of decoded masks kept in memory
+        """
+        self.path = bboxFile
+        self.budget = budget
+        self.cache = OrderedDict()  # index -> cropped mask, in LRU order
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.shard = None
+        self.active = None  # indices of the masks sampled, all if None
+        if bboxFile.endswith('.shard'):
+            self.load_shard(bboxFile)
+        else:
+            self.load_index(bboxFile)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getstate__(self):
+        # worker processes start with an empty cache and map the shard themselves
+        state = self.__dict__.copy()
+        state['cache'] = OrderedDict()
+        state['nbytes'] = 0
+        state['shard'] = None
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        if self.path.endswith('.shard'):
+            self.shard = maskShard(self.path)
+
+    def load_index(self, bboxFile):
+        """parses the bbox file into a list of (mask file, [topx, topy, botx, boty])"""
+        self.entries = []
+        with open(bboxFile, 'r') as f:
+            for line in f.read().split('\n'):
+                if len(line) == 0:
+                    continue
+                words = line.split(',')
+                coord = [int(util.strip_paren(item).strip()) for item in words[1:]]
+                self.entries.append((words[0], coord))
+
+    def load_shard(self, path):
+        """memory-maps a mask shard"""
+        self.shard = maskShard(path)
+        self.entries = [(path, list(entry['bbox'])) for entry in self.shard.index]
+
+    def get(self, ind):
+        """returns the BGR mask cropped to its bbox, decoding it on a cache miss"""
+        with self.lock:
+            if ind in self.cache:
+                self.cache.move_to_end(ind)
+                return self.cache[ind]
+
+        if self.shard is not None:
+            sliced = self.shard.get(ind)
+        else:
+            maskFile, (topx, topy, botx, boty) = self.entries[ind]
+            img = imgio.imread(maskFile)
+            sliced = img[topy:boty, topx:botx, :].copy()
+        sliced.flags.writeable = False  # shared between samples
+
+        # evict the least recently used masks to stay within the budget
+        with self.lock:
+            if ind not in self.cache:
+                self.cache[ind] = sliced
+                self.nbytes += sliced.nbytes
+            while self.nbytes > self.budget and len(self.cache) > 1:
+                _, old = self.cache.popitem(last=False)
+                self.nbytes -= old.nbytes
+
+        return sliced
+
+    def get_alpha(self, ind):
+        """returns the alpha of a mask, nonzero on the object"""
+        if self.shard is not None:
+            return self.shard.get_alpha(ind)
+
+        return composite.blend_alpha(self.get(ind))
+
+    def keys(self):
+        """
+        returns an identifier per mask, which changes when the mask file is rewritten,
+        to find the images made from masks that are gone or changed
+        """
+        if self.shard is not None:
+            return [f'{self.path}:{entry["offset"]}:{entry["frame"]}:{tuple(entry["bbox"])}' for entry in self.shard.index]
+
+        res = []
+        for maskFile, coord in self.entries:
+            st = os.stat(maskFile)
+            res.append(f'{maskFile}:{st.st_mtime_ns}:{st.st_size}:{tuple(coord)}')
+        return res
+
+    def split(self, share, block=16, seed=0):
+        """
+        returns the indices of the train and test masks, two disjoint sets, the test set
+        holding out about share of the masks. Consecutive masks come from neighbouring
+        frames of a video and look alike, so they are held out by blocks of block masks,
+        shrunk to half the bank when it is smaller than two blocks
+        """
+        assert(len(self.entries) > 1), 'Too few masks to hold some out, at least 2 are needed'
+        block = min(block, max(1, len(self.entries) // 2))
+        starts = np.arange(0, len(self.entries), block)
+        held = np.zeros(len(self.entries), dtype=bool)
+        k = min(max(1, int(round(share * len(starts)))), len(starts) - 1)
+        for start in np.random.RandomState(seed).permutation(starts)[:k]:
+            held[start:start+block] = True
+
+        return np.flatnonzero(~held), np.flatnonzero(held)
+
+    def subset(self, indices):
+        """returns a view of the bank sampling only the masks at indices, with its own cache"""
+        view = copy.copy(self)
+        view.active = np.asarray(indices)
+        view.cache = OrderedDict()
+        view.nbytes = 0
+        view.lock = threading.Lock()
+
+        return view
+
+    def sample(self, rng=np.random):
+        """randomly chooses a mask and returns its index and the cropped mask"""
+        if self.active is None:
+            ind = rng.randint(len(self.entries))
+        else:
+            ind = int(self.active[rng.randint(len(self.active))])
+        return ind, self.get(ind)
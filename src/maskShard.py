@@ -0,0 +1,112 @@
+"""
+This script contains the compact storage format for object masks. Instead of a full video frame
+per mask, only the object cropped to its bbox is stored, JPEG-encoded, together with its binary
+alpha packed to one bit per pixel.
+
+    <name>.shard     per crop, the JPEG bytes of the BGR crop followed by its packed alpha
+    <name>.idx.npy   index with offset, JPEG size, shape, bbox and source frame of every crop
+
+The shard and its index are memory-mapped for reading, so the alpha is unpacked from a zero-copy
+slice of the file and the crop is decoded from one. The mask bank keeps the decoded crops in its
+LRU cache.
+"""
+import cv2
+import numpy as np
+import os
+import shutil
+
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('size', '<u8'), ('height', '<u4'), ('width', '<u4'),
+                        ('bbox', '<i4', (4,)), ('frame', '<i8')])
+
+def index_path(path):
+    """returns the index file path of a shard"""
+    return os.path.splitext(path)[0] + '.idx.npy'
+
+def encode(crop, alpha, quality=95):
+    """returns the record of a crop stored in a shard, its JPEG bytes and its packed alpha"""
+    buf = cv2.imencode('.jpg', crop, [cv2.IMWRITE_JPEG_QUALITY, quality])[1]
+    return buf.tobytes(), np.packbits(alpha != 0).tobytes(), crop.shape[0], crop.shape[1]
+
+def record_size(size, h, w):
+    """bytes taken in the shard by a crop of JPEG size bytes and shape h x w"""
+    return int(size) + (int(h) * int(w) + 7) // 8
+
+class maskShardWriter(object):
+    def __init__(self, path):
+        """opens a shard for appending, keeping the masks already in it"""
+        self.path = path
+        if os.path.exists(path) and os.path.exists(index_path(path)):
+            self.index = [tuple(entry) for entry in np.load(index_path(path))]
+        else:
+            self.index = []
+        self.f = open(path, 'ab')
+        self.f.truncate(self.end())
+
+    def end(self):
+        """byte offset right after the last indexed crop"""
+        if len(self.index) == 0:
+            return 0
+        offset, size, h, w = self.index[-1][:4]
+        return int(offset) + record_size(size, h, w)
+
+    def add(self, record, bbox, frame):
+        """
+        appends a crop to the shard
+
+        args:
+            record: crop as returned by encode
+            bbox: (topx, topy, botx, boty) in the source frame
+            frame: index of the source frame in the video
+        """
+        buf, bits, h, w = record
+        offset = self.end()
+        self.f.write(buf)
+        self.f.write(bits)
+        self.index.append((offset, len(buf), h, w, tuple(bbox), frame))
+
+    def close(self):
+        """flushes the crops and writes the index"""
+        self.f.close()
+        np.save(index_path(self.path), np.array(self.index, dtype=INDEX_DTYPE))
+
+def merge(paths, path):
+    """appends the crops of the shards at paths to the shard at path, in order, and removes them"""
+    writer = maskShardWriter(path)
+    for part in paths:
+        base = writer.end()
+        with open(part, 'rb') as f:
+            shutil.copyfileobj(f, writer.f, 2**24)
+        for offset, size, h, w, bbox, frame in np.load(index_path(part)):
+            writer.index.append((base + int(offset), size, h, w, tuple(bbox), frame))
+    writer.close()
+    for part in paths:
+        os.remove(part)
+        os.remove(index_path(part))
+
+class maskShard(object):
+    def __init__(self, path):
+        """memory-maps a shard and its index for reading"""
+        self.path = path
+        self.index = np.load(index_path(path), mmap_mode='r')
+        if os.path.getsize(path) > 0:
+            self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        else:
+            self.data = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, ind):
+        """decodes the BGR crop of a mask"""
+        entry = self.index[ind]
+        start = int(entry['offset'])
+
+        return cv2.imdecode(self.data[start:start + int(entry['size'])], cv2.IMREAD_COLOR)
+
+    def get_alpha(self, ind):
+        """returns the 0/1 alpha of a mask, unpacked from the shard"""
+        entry = self.index[ind]
+        start = int(entry['offset']) + int(entry['size'])
+        h, w = int(entry['height']), int(entry['width'])
+
+        return np.unpackbits(self.data[start:start + (h*w + 7) // 8], count=h*w).reshape(h, w)
@@ -0,0 +1,153 @@
+"""
+This script contains the packed output format of createDataset. Instead of a JPEG file and a label
+file per sample, the encoded images and their YOLO label lines are appended to tar files of a
+capped size, so a dataset of 100k samples is a few hundred files.
+
+    <dest>/shards/<mode>-<part>-<n>.tar       <key>.jpg and <key>.txt members, in order
+    <dest>/shards/<mode>-<part>-<n>.idx.npy   key, offset and size of the image and label of every sample
+
+The tar files can be read by any tar tool. The index gives the byte range of every member, so a
+sample is read with a single slice of the memory-mapped tar file. <dest>/<mode>.txt lists the tar
+files of the dataset. Run this script to export a packed dataset to the layout of loose files.
+"""
+import argparse
+import bisect
+import io
+import numpy as np
+import os
+import tarfile
+
+INDEX_DTYPE = np.dtype([('key', 'S64'), ('image_offset', '<u8'), ('image_size', '<u8'),
+                        ('label_offset', '<u8'), ('label_size', '<u8')])
+
+def index_path(path):
+    """returns the index file path of a tar shard"""
+    return os.path.splitext(path)[0] + '.idx.npy'
+
+class packShardWriter(object):
+    def __init__(self, base, cap=1024*2**20):
+        """
+        appends samples to tar files base-00000.tar, base-00001.tar, ...
+
+        args:
+            base: path of the tar files without the counter and extension
+            cap: size in bytes after which the next tar file is started
+        """
+        self.base = base
+        self.cap = cap
+        self.paths = []     # tar files written
+        self.tar = None
+        os.makedirs(os.path.dirname(os.path.abspath(base)), exist_ok=True)
+
+    def open(self):
+        path = f'{self.base}-{len(self.paths):05d}.tar'
+        self.paths.append(path)
+        self.tar = tarfile.open(path, 'w', format=tarfile.USTAR_FORMAT)
+        self.index = []
+
+    def member(self, name, data):
+        """appends a file to the tar and returns the offset of its data"""
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self.tar.addfile(info, io.BytesIO(data))
+        # the data is padded to 512-byte blocks right after the header
+        return self.tar.offset - -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+    def add(self, key, image, label):
+        """
+        appends a sample and returns the tar file it went to
+
+        args:
+            key: name of the sample, e.g. COCO_2014_train12
+            image: encoded JPEG bytes
+            label: YOLO label lines
+        """
+        if self.tar is not None and self.tar.offset + len(image) + len(label) > self.cap:
+            self.close()
+        if self.tar is None:
+            self.open()
+        label = label.encode()
+        image_offset = self.member(key + '.jpg', bytes(image))
+        label_offset = self.member(key + '.txt', label)
+        self.index.append((key.encode(), image_offset, len(image), label_offset, len(label)))
+
+        return self.paths[-1]
+
+    def close(self):
+        """finishes the tar file being written and writes its index"""
+        if self.tar is None:
+            return
+        self.tar.close()
+        np.save(index_path(self.paths[-1]), np.array(self.index, dtype=INDEX_DTYPE))
+        self.tar = None
+
+class packShard(object):
+    def __init__(self, path):
+        """memory-maps a tar shard for reading"""
+        self.path = path
+        self.index = np.load(index_path(path))
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+
+    def __len__(self):
+        return len(self.index)
+
+    def key(self, ind):
+        return self.index[ind]['key'].decode()
+
+    def get(self, ind):
+        """returns the encoded image as a read-only uint8 view into the tar file, and the label lines"""
+        entry = self.index[ind]
+        start = int(entry['image_offset'])
+        image = self.data[start:start + int(entry['image_size'])]
+        start = int(entry['label_offset'])
+        label = self.data[start:start + int(entry['label_size'])].tobytes().decode()
+
+        return image, label
+
+class packDataset(object):
+    def __init__(self, listFile):
+        """opens all the tar shards listed in a dataset list file"""
+        with open(listFile, 'r') as f:
+            self.shards = [packShard(line) for line in f.read().split('\n') if line]
+        self.start = np.cumsum([0] + [len(shard) for shard in self.shards]).tolist()
+
+    def __len__(self):
+        return self.start[-1]
+
+    def __getitem__(self, ind):
+        """returns the key, encoded image and label lines of sample ind"""
+        s = bisect.bisect_right(self.start, ind) - 1
+        image, label = self.shards[s].get(ind - self.start[s])
+        return self.shards[s].key(ind - self.start[s]), image, label
+
+def export(listFile, dest, mode):
+    """writes a packed dataset to dest in the layout of loose files of createDataset, with its list file"""
+    data = packDataset(listFile)
+    os.makedirs(f'{dest}/images/{mode}', exist_ok=True)
+    os.makedirs(f'{dest}/labels/{mode}', exist_ok=True)
+    with open(f'{dest}/{mode}.txt', 'w') as fnewList:
+        for ind in range(len(data)):
+            key, image, label = data[ind]
+            newImage = f'{dest}/images/{mode}/{key}.jpg'
+            with open(newImage, 'wb') as f:
+                f.write(image)
+            with open(f'{dest}/labels/{mode}/{key}.txt', 'w') as f:
+                f.write(label)
+            fnewList.write(newImage + '\n')
+            if ind % 1000 == 0:
+                print(f'[INFO] {ind} of {len(data)} samples exported')
+
+    return len(data)
+
+def main():
+    ap = argparse.ArgumentParser(description='Export a packed dataset to loose image and label files.')
+    ap.add_argument('-l', '--list', required=True, help='list file of the packed dataset, e.g. <DET>/train.txt')
+    ap.add_argument('-d', '--dest', required=True, help='destination folder')
+    ap.add_argument('-m', '--mode', default='train', help='train or test')
+    args = vars(ap.parse_args())
+
+    num = export(args['list'], os.path.abspath(args['dest']), args['mode'])
+    print(f'[INFO] {num} samples exported to {args["dest"]}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""
+This script contains the quality metrics of the masks found by yoloMask, computed on the largest
+contour of a frame before the mask is encoded, and the perceptual hash used to drop masks that are
+near-duplicates of one already saved.
+
+    area:      contour area over frame area
+    solidity:  contour area over the area of its convex hull, low for ragged or broken masks
+    border:    whether the bbox touches the frame border, i.e. the object is cut off
+    sharpness: variance of the Laplacian of the object, low for motion blur
+"""
+import cv2
+import numpy as np
+
+def metrics(frame, c, bbox):
+    """returns the quality metrics of contour c found in frame, with bbox (topx, topy, botx, boty)"""
+    h, w = frame.shape[:2]
+    topx, topy, botx, boty = bbox
+    area = cv2.contourArea(c)
+    hull = cv2.contourArea(cv2.convexHull(c))
+    gray = cv2.cvtColor(frame[topy:boty+1, topx:botx+1], cv2.COLOR_BGR2GRAY)
+
+    return {'area': area / (h * w),
+            'solidity': area / hull if hull > 0 else 0.0,
+            'border': topx <= 0 or topy <= 0 or botx >= w - 1 or boty >= h - 1,
+            'sharpness': float(cv2.Laplacian(gray, cv2.CV_64F).var()) if gray.size else 0.0}
+
+def phash(frame, bbox):
+    """returns the 64-bit perceptual hash of the object in bbox as 8 uint8"""
+    topx, topy, botx, boty = bbox
+    gray = cv2.cvtColor(frame[topy:boty+1, topx:botx+1], cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8].flatten()
+
+    # DC term left out of the median, it only carries the brightness
+    return np.packbits(low > np.median(low[1:]))
+
+def hamming(hashes, h):
+    """returns the Hamming distance between hash h and each row of hashes"""
+    return np.unpackbits(hashes ^ h, axis=1).sum(axis=1)
@@ -0,0 +1,62 @@
+"""
+This script contains the training-resolution output of createDataset. Images are brought to the
+square input size of the trainer, either letterboxed (scaled to fit, aspect kept, and padded) or
+resized (stretched). JPEG images are decoded by libjpeg at 1/2, 1/4 or 1/8 scale when that is
+still at least the scaled size, so a large background is never decoded at full size only to be
+shrunk. The YOLO boxes, normalized to the scaled image, are mapped to the padded one.
+"""
+import cv2
+import imgio
+import numpy as np
+import util
+
+PAD = 114   # gray of the letterbox padding
+
+REDUCED = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+def fit(h, w, size, mode='letterbox'):
+    """returns the (width, height) an h x w image is scaled to, before padding"""
+    if mode == 'resize':
+        return size, size
+    s = size / max(h, w)
+    return max(1, round(w * s)), max(1, round(h * s))
+
+def reduced_flag(h, w, tw, th):
+    """returns the imread flag of the smallest decode scale of an h x w image still at least tw x th"""
+    for r, flag in REDUCED:
+        if w // r >= tw and h // r >= th:
+            return flag
+    return cv2.IMREAD_COLOR
+
+def load(path, size, mode='letterbox'):
+    """decodes a color image scaled to fit size, through the reduced decode of JPEG files"""
+    header = util.jpeg_header(path)
+    flag = cv2.IMREAD_COLOR
+    if header is not None:
+        h, w = header[:2]
+        flag = reduced_flag(h, w, *fit(h, w, size, mode))
+    img = imgio.imread(path, flag)
+
+    # EXIF orientation may swap the sides, so the target is taken from the decoded image
+    tw, th = fit(*img.shape[:2], size, mode)
+    if img.shape[:2] != (th, tw):
+        img = cv2.resize(img, (tw, th), interpolation=cv2.INTER_AREA)
+    return img
+
+def letterbox(img, xywh, size, mode='letterbox'):
+    """
+    pads an image scaled by fit to size x size, centered, and maps its YOLO boxes,
+    an (n, 4) array of x, y, w, h normalized to the image, to the padded image
+    """
+    xywh = np.asarray(xywh, dtype=np.float64).reshape(-1, 4)
+    h, w = img.shape[:2]
+    if mode == 'resize' or (h, w) == (size, size):
+        return img, xywh
+
+    top, left = (size - h) // 2, (size - w) // 2
+    img = cv2.copyMakeBorder(img, top, size - h - top, left, size - w - left, cv2.BORDER_CONSTANT, value=(PAD, PAD, PAD))
+    xywh = xywh * [w, h, w, h] / size
+    xywh[:, 0] += left / size
+    xywh[:, 1] += top / size
+
+    return img, xywh
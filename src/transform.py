@@ -0,0 +1,86 @@
+"""
+This script contains the geometric transform of the masks used by createDataset. Crop, flip, shear,
+rotation and scale are composed into a single affine matrix so the mask is resampled only once.
+Rotations by multiples of 90 degrees without shear are done losslessly with transpose/flip and
+only the scaling resamples. The result is cropped tight to the transformed alpha.
+"""
+import cv2
+import numpy as np
+
+ROTATE = {90: cv2.ROTATE_90_CLOCKWISE, 180: cv2.ROTATE_180, 270: cv2.ROTATE_90_COUNTERCLOCKWISE}
+
+def linear(angle, scale=1.0, flip=False, shear=0.0):
+    """
+    returns the 2x2 matrix flipping horizontally, shearing along x by shear degrees,
+    rotating clockwise by angle degrees and scaling, in that order
+    """
+    a = np.deg2rad(angle)
+    R = np.array([[np.cos(a), -np.sin(a)], [np.sin(a), np.cos(a)]])
+    S = np.array([[1.0, np.tan(np.deg2rad(shear))], [0.0, 1.0]])
+    F = np.diag([-1.0 if flip else 1.0, 1.0])
+
+    return scale * (R @ S @ F)
+
+def fit_scale(w, h, target_width, angle, flip=False, shear=0.0):
+    """returns the scale making the bounding box of the transformed w x h rect target_width wide"""
+    A = linear(angle, 1.0, flip, shear)
+    corners = A @ np.array([[0, w, w, 0], [0, 0, h, h]], dtype=np.float64)
+    width = corners[0].max() - corners[0].min()
+
+    return target_width / width
+
+def is_right(angle, shear=0.0):
+    """whether the transform can take the lossless path"""
+    return shear == 0 and float(angle) % 90 == 0
+
+def warp(img, alpha, angle=0, scale=1.0, flip=False, shear=0.0, rect=None):
+    """
+    transforms img and its alpha with a single resample and crops both tight to the alpha
+
+    args:
+        img: image holding the mask
+        alpha: uint8 alpha of img, nonzero on the object
+        angle: clockwise rotation in degrees
+        scale: scale factor
+        flip: flip horizontally
+        shear: shear along x in degrees
+        rect: (topx, topy, botx, boty) to crop from img and alpha first, whole image if None
+    """
+    if rect is None:
+        rect = (0, 0, img.shape[1], img.shape[0])
+    topx, topy, botx, boty = rect
+    w, h = botx - topx, boty - topy
+
+    if is_right(angle, shear):
+        # crop is a view, flip and rotation are lossless, only the resize resamples
+        img = img[topy:boty, topx:botx]
+        alpha = alpha[topy:boty, topx:botx]
+        if flip:
+            img, alpha = cv2.flip(img, 1), cv2.flip(alpha, 1)
+        rot = int(angle) % 360
+        if rot in ROTATE:
+            img, alpha = cv2.rotate(img, ROTATE[rot]), cv2.rotate(alpha, ROTATE[rot])
+        if scale != 1.0:
+            dim = (max(1, int(round(img.shape[1] * scale))), max(1, int(round(img.shape[0] * scale))))
+            interp = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LINEAR
+            img = cv2.resize(img, dim, interpolation=interp)
+            alpha = cv2.resize(alpha, dim, interpolation=cv2.INTER_NEAREST)
+    else:
+        A = linear(angle, scale, flip, shear)
+        corners = A @ np.array([[0, w, w, 0], [0, 0, h, h]], dtype=np.float64)
+        lo = corners.min(axis=1)
+        dsize = tuple(int(v) for v in np.ceil(corners.max(axis=1) - lo))
+
+        # source pixel -> crop -> transformed -> shifted into the output
+        M = np.zeros((2, 3))
+        M[:, :2] = A
+        M[:, 2] = -A @ np.array([topx, topy]) - lo
+        img = cv2.warpAffine(img, M, dsize, flags=cv2.INTER_LINEAR)
+        alpha = cv2.warpAffine(alpha, M, dsize, flags=cv2.INTER_NEAREST)
+
+    # tight bbox of the transformed alpha
+    x, y, bw, bh = cv2.boundingRect(alpha)
+    if bw == 0 or bh == 0:
+        return img, alpha
+
+    return img[y:y+bh, x:x+bw], alpha[y:y+bh, x:x+bw]
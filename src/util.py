@@ -5,9 +5,9 @@ Last Modified: 11/02/2019
 This script contains a number of helper functions
 """
 import cv2
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
 import numpy as np
+import shutil
+import struct
 
 def get_contours(cnts):
     """
@@ -81,35 +81,14 @@ def rotate_bound(image, angle):
     return cv2.warpAffine(image, M, (nW, nH))
 
 def showimg(img, bgr=False, gray=False):
-    """
-    shows the image, being handled with opencv, in-line with matplotlib
-    
-    args:
-        gray: Grayscale option (True or False)
-        bgr: opencv flips RGB to BGR (True or False)
-    """
-    # feel free to resize the figure size as necessary
-    plt.figure(figsize = (8, 10))
-    
-    if bgr:
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        imgplot = plt.imshow(img)
-    elif gray:
-        imgplot = plt.imshow(img, cmap='gray')
-    else:    
-        imgplot = plt.imshow(img)
-    plt.show()
-
+    """shows the image in-line with matplotlib, see vis.showimg. matplotlib is loaded on the first call"""
+    import vis
+    vis.showimg(img, bgr, gray)
 
 def showimg_file(file):
-    """
-    displays the image directly from the file, in-line with matplotlib
-    """
-    img = mpimg.imread(file) 
-    # feel free to resize the figure size as necessary
-    plt.figure(figsize = (8, 10))
-    imgplot = plt.imshow(img)
-    plt.show()
+    """displays the image directly from the file, see vis.showimg_file"""
+    import vis
+    vis.showimg_file(file)
 
 def strip_paren(text):
     """
@@ -121,3 +100,81 @@ def strip_paren(text):
             split.pop(split.index(i))
     res = ''.join(split)
     return res
+
+def shrink_boxes(xywh, factor=0.95):
+    """
+    shrinks the YOLO boxes stepping outside the image around their center, by the
+    smallest power of factor that makes them fit, and returns the new boxes and a flag
+    of the boxes that can fit at all (center strictly inside the image)
+
+    the result matches shrinking with a `w *= factor` loop until the box fits, within a
+    relative tolerance of 1e-12 on w and h (power vs repeated multiplication)
+
+    args:
+        xywh: (n, 4) array of YOLO x, y, w, h
+    """
+    x, y, w, h = xywh.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # largest scale keeping the box inside the image
+        rx = np.where(w > 0, 2 * np.minimum(x, 1.0 - x) / w, np.inf)
+        ry = np.where(h > 0, 2 * np.minimum(y, 1.0 - y) / h, np.inf)
+    r = np.minimum(rx, ry)
+    valid = (x > 0) & (x < 1) & (y > 0) & (y < 1)
+
+    n = np.zeros(len(r))
+    shrink = valid & (r < 1.0)
+    n[shrink] = np.ceil(np.log(r[shrink]) / np.log(factor))
+
+    # the log ratio can round either way: one more step where the box is a hair outside,
+    # one less where the box already fits exactly on the border a step earlier
+    def outside(n):
+        sw, sh = w * factor**n, h * factor**n
+        return ~((x - sw/2 >= 0.0) & (x + sw/2 <= 1.0) & (y - sh/2 >= 0.0) & (y + sh/2 <= 1.0))
+    n[shrink & outside(n)] += 1
+    n[shrink & (n > 0) & ~outside(n - 1)] -= 1
+
+    res = xywh.astype(np.float64, copy=True)
+    res[:, 2] = w * factor**n
+    res[:, 3] = h * factor**n
+
+    return res, valid
+
+def jpeg_header(path):
+    """
+    reads (height, width, channels) from the frame header of a JPEG file without
+    decoding it. Returns None if the file is not a JPEG or has no frame header
+    """
+    with open(path, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            return None
+        while True:
+            # skip to the next marker
+            b = f.read(1)
+            while b and b != b'\xff':
+                b = f.read(1)
+            while b == b'\xff':
+                b = f.read(1)
+            if not b:
+                return None
+            marker = b[0]
+            if marker == 0x01 or 0xd0 <= marker <= 0xd9:
+                continue    # markers without a length
+            length = struct.unpack('>H', f.read(2))[0]
+            # start of frame markers, all but DHT, JPG and DAC
+            if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                _, h, w, channels = struct.unpack('>BHHB', f.read(6))
+                return h, w, channels
+            f.seek(length - 2, 1)
+
+def reflink(src, dst):
+    """
+    clones a file with a copy-on-write reflink where the filesystem supports it
+    (btrfs, xfs), and copies it otherwise
+    """
+    FICLONE = 0x40049409
+    try:
+        import fcntl
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except (ImportError, OSError):
+        shutil.copyfile(src, dst)
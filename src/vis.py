@@ -0,0 +1,38 @@
+"""
+This script contains the helpers showing images in-line with matplotlib, used in test mode and
+in the notebook. It is the only module importing matplotlib, so import it where the images are
+shown, not at the top of a module, to keep the other entry points from loading it.
+"""
+import cv2
+import matplotlib.pyplot as plt
+
+def showimg(img, bgr=False, gray=False):
+    """
+    shows the image, being handled with opencv, in-line with matplotlib
+
+    args:
+        gray: Grayscale option (True or False)
+        bgr: opencv flips RGB to BGR (True or False)
+    """
+    # feel free to resize the figure size as necessary
+    plt.figure(figsize = (8, 10))
+
+    if bgr:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        imgplot = plt.imshow(img)
+    elif gray:
+        imgplot = plt.imshow(img, cmap='gray')
+    else:
+        imgplot = plt.imshow(img)
+    plt.show()
+
+
+def showimg_file(file):
+    """
+    displays the image directly from the file, in-line with matplotlib
+    """
+    img = cv2.cvtColor(cv2.imread(file), cv2.COLOR_BGR2RGB)
+    # feel free to resize the figure size as necessary
+    plt.figure(figsize = (8, 10))
+    imgplot = plt.imshow(img)
+    plt.show()
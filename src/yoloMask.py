@@ -8,15 +8,31 @@ The code is to generate mask of an object processing and extracting an object fr
     Output: Image files containing object mask
 """
 import argparse
+from contextlib import redirect_stdout
 import cv2
+import glob
+import instrument
+import maskShard
+import multiprocessing as mp
 import numpy as np
 import os
+import quality
+import queue
+import threading
 import util
+from maskShard import maskShardWriter
 
 class generateMask(object):
     def __init__(self, vis=False):
         self.path = os.getcwd()
         self.vis = vis  # flag for visualization
+        self.fmt = 'jpg'    # output format, 'jpg' or 'shard'
+        self.outDir = None  # output directory, data/mask if None
+        self.shard = None
+        self.set_stats()
+        self.set_quality()
+        self.set_search()
+        self.set_buffers()
 
     def set_thresh(self, thresh):
         try:
@@ -29,59 +45,659 @@ class generateMask(object):
     def set_objName(self, obj_name):
         self.obj_name = obj_name
 
+    def set_outDir(self, path):
+        """sets the directory the masks are written to, data/mask if None"""
+        self.outDir = path
+
+    def set_format(self, fmt):
+        """
+        sets the output format
+
+            - jpg: full frame mask per JPEG file and bbox text file
+            - shard: bbox-cropped JPEG masks and packed alphas in a single shard file
+        """
+        assert fmt in ['jpg', 'shard'], 'Format should be either \'jpg\' or \'shard\'.'
+        self.fmt = fmt
+
+    def set_buffers(self, reuse=False):
+        """
+        with reuse, create_mask and the full frame search write into uint8 buffers allocated
+        once for the frame size: the masked frame, the mask, the grayscale and the eroded frame,
+        6 bytes per pixel in all, e.g. 50 MB at 3840x2160, on top of the decoded frame.
+        Nothing else of frame size is allocated per frame. The masked frame returned by
+        create_mask is then a view of its buffer, valid until the next call
+        """
+        self.reuse = reuse
+        self.buffers = None
+        self.dirty = None   # bbox painted in the masked frame buffer by the last call
+
+    def frame_buffers(self, frame):
+        """returns the masked frame, mask, grayscale and eroded frame buffers, allocated for the frame size"""
+        if self.buffers is None or self.buffers[0].shape != frame.shape:
+            h, w = frame.shape[:2]
+            self.buffers = (np.zeros_like(frame), np.zeros((h, w), dtype=np.uint8),
+                            np.empty((h, w), dtype=np.uint8), np.empty((h, w), dtype=np.uint8))
+            self.dirty = None
+        return self.buffers
+
+    def set_search(self, mode='full', levels=2, pad=0.5, ratio=0.5):
+        """
+        sets how the object is searched in a frame
+
+            - full: threshold and contour search over the whole frame
+            - fast: coarse search on a frame subsampled by 2**levels, or around the bbox of
+                    the previous frame, then the contour search at full resolution only inside
+                    that region padded by pad times the bbox size. The region is dropped when
+                    the object is lost or crosses its border, or when a blob outside it has at
+                    least ratio times the subsampled area of the largest blob inside. The search
+                    then goes on around the coarse bbox, and last over the full frame. The contour
+                    is the one of the full search unless subsampling misses or misjudges blobs of
+                    a few 2**levels pixels
+        """
+        assert mode in ['full', 'fast'], 'Search should be either \'full\' or \'fast\'.'
+        self.search = mode
+        self.levels = levels
+        self.pad = pad
+        self.ratio = ratio
+        self.roi = None     # bbox of the object in the previous frame
+
+    def set_quality(self, min_area=None, max_area=None, min_solidity=None, border=False,
+                    min_sharpness=None, dedup=None):
+        """
+        sets the gates a mask has to pass to be saved, None or False to turn a gate off
+
+        args:
+            min_area, max_area: bounds of the contour area as a fraction of the frame area
+            min_solidity: min contour area over the area of its convex hull
+            border: drop masks whose bbox touches the frame border
+            min_sharpness: min variance of the Laplacian of the object
+            dedup: drop masks within this Hamming distance of the perceptual hash
+                   of a mask already saved
+        """
+        self.gates = {'min_area': min_area, 'max_area': max_area, 'min_solidity': min_solidity,
+                      'border': border, 'min_sharpness': min_sharpness}
+        self.dedup = dedup
+        self.hashes = np.zeros((0, 8), dtype=np.uint8)   # perceptual hashes of the saved masks
+
+    def set_stats(self, log=None, every=100, name='generate'):
+        """
+        set the instrumentation of generate mode
+
+        args:
+            log: file to append JSON progress lines and the summary to, '-' for stdout
+            every: emit a progress line every n masks
+        """
+        self.stats = instrument.stageStats(name, log, every)
+
     def load_video(self, video_file):
         return cv2.VideoCapture(video_file)
 
-    def create_mask(self, frame):
+    def sample_frames(self, cap, stride=None, rate=None, ranges=None):
+        """
+        yields (frame index, frame) for the sampled frames only
+
+        frames that are not sampled are only grabbed, never retrieved, so they
+        are not converted to BGR arrays. Time ranges are reached by seeking.
+
+        args:
+            stride: keep every n-th frame
+            rate: target number of masks per second of video (overrides stride)
+            ranges: list of (start, end) tuples in seconds. Whole video if None
+        """
+        fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+        total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if stride is None:
+            stride = 10
+        if ranges is None:
+            ranges = [(0.0, None)]
+
+        self.sample_stats = {'fps': fps, 'grabbed': 0, 'sampled': 0, 'seconds': 0.0}
+        pos = int(cap.get(cv2.CAP_PROP_POS_FRAMES))    # index of the next frame grabbed
+        for start, end in ranges:
+            first = int(round(start * fps))
+            last = int(round(end * fps)) if end is not None else None
+            if first != pos:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, first)
+
+            ind = first
+            next_time = start  # next sample time in rate mode
+            while last is None or ind < last:
+                with self.stats.stage('grab'):
+                    ok = cap.grab()
+                if not ok:
+                    break
+                self.sample_stats['grabbed'] += 1
+                if rate:
+                    keep = (ind / fps) >= next_time
+                    if keep:
+                        next_time += 1.0 / rate
+                else:
+                    keep = (ind - first) % stride == 0
+                if keep:
+                    with self.stats.stage('retrieve'):
+                        ret, frame = cap.retrieve()
+                    if ret:
+                        self.sample_stats['sampled'] += 1
+                        yield ind, frame
+                ind += 1
+            pos = ind
+            self.sample_stats['seconds'] += (ind - first) / fps
+
+        # effective sampling rate achieved
+        seconds = self.sample_stats['seconds']
+        self.sample_stats['rate'] = self.sample_stats['sampled'] / seconds if seconds else 0.0
+        if total > 0:
+            self.sample_stats['coverage'] = self.sample_stats['grabbed'] / total
+
+    def find_object(self, frame):
+        """returns the largest contour in the frame and its bbox coordinates, None if there is none"""
+        if self.search == 'fast':
+            # around the previous bbox, then around the coarse bbox
+            blobs = self.find_blobs(frame)
+            for box in ([self.roi] if self.roi is not None else []) + [None]:
+                found = self.find_fast(frame, blobs, box)
+                if found is not None:
+                    self.roi = found[1]
+                    return found
+                self.stats.count('search_lost' if box is not None else 'search_fallback')
+
+        found = self.find_in(frame)
+        self.roi = found[1] if found is not None else None
+        return found
+
+    def find_in(self, frame, rect=None):
+        """
+        returns the largest contour in rect (topx, topy, botx, boty) of the frame, whole frame
+        if None, and its bbox. None if nothing is above the threshold
+        """
+        topx, topy = 0, 0
+        if rect is not None:
+            topx, topy, botx, boty = rect
+            frame = frame[topy:boty, topx:botx]
+
 	# image processing
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        thresh = cv2.threshold(gray, self.low, self.high, cv2.THRESH_BINARY)[1]
-        erode = cv2.erode(thresh, None, iterations=1)
-        cnts = cv2.findContours(erode, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        if self.reuse and rect is None:
+            _, _, gray, erode = self.frame_buffers(frame)
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray)
+            cv2.threshold(gray, self.low, self.high, cv2.THRESH_BINARY, dst=gray)
+            cv2.erode(gray, None, dst=erode, iterations=1)
+        else:
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            thresh = cv2.threshold(gray, self.low, self.high, cv2.THRESH_BINARY)[1]
+            erode = cv2.erode(thresh, None, iterations=1)
+        cnts = cv2.findContours(erode, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(topx, topy))
         cnts = util.get_contours(cnts)
+        if len(cnts) == 0:
+            return None
         c = max(cnts, key=cv2.contourArea)
-            
-        # mask generation
-        mask = np.zeros((frame.shape[0], frame.shape[1]))
-        cv2.drawContours(mask, [c], -1, (1,0,0), cv2.FILLED)
-            
+
         # bounding box
         extLeft = tuple(c[c[:, :, 0].argmin()][0])
         extRight = tuple(c[c[:, :, 0].argmax()][0])
         extTop = tuple(c[c[:, :, 1].argmin()][0])
         extBot = tuple(c[c[:, :, 1].argmax()][0])
-        bbox_coord = (extLeft[0], extTop[1], extRight[0], extBot[1])
-       
-        # apply mask
-        masked = frame.copy()
-        for i in range(3):
-            masked[:, :, i] *= (mask != 0)
+        bbox_coord = (int(extLeft[0]), int(extTop[1]), int(extRight[0]), int(extBot[1]))
+
+        return c, bbox_coord
+
+    def find_blobs(self, frame):
+        """
+        returns the bboxes (topx, topy, botx, boty) scaled to the frame, with a margin of one
+        subsampled pixel, and the contour areas of the blobs above the threshold in the frame
+        subsampled by 2**levels
+        """
+        h, w = frame.shape[:2]
+        f = 2 ** self.levels
+        small = cv2.resize(frame, (w // f, h // f), interpolation=cv2.INTER_NEAREST)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        thresh = cv2.threshold(gray, self.low, self.high, cv2.THRESH_BINARY)[1]
+        cnts = util.get_contours(cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE))
+        x, y, bw, bh = np.array([cv2.boundingRect(c) for c in cnts]).reshape(-1, 4).T
+        boxes = np.stack([x * f - f, y * f - f, (x + bw) * f + f, (y + bh) * f + f], axis=1)
+        area = np.array([cv2.contourArea(c) for c in cnts]).reshape(-1)
+        return boxes, area
+
+    def find_fast(self, frame, blobs, box=None):
+        """
+        returns the largest contour and its bbox searched in box padded, or around the largest
+        of the blobs found by find_blobs if None. None if the object is lost, i.e. nothing found
+        or the contour reaches the region border, or if a blob outside the region may be larger
+        """
+        h, w = frame.shape[:2]
+        boxes, area = blobs
+        if box is None:
+            if len(area) == 0:
+                return None
+            box = tuple(int(v) for v in boxes[area.argmax()])
+
+        pad = int(self.pad * max(box[2] - box[0], box[3] - box[1])) + 2
+        rect = (max(box[0] - pad, 0), max(box[1] - pad, 0), min(box[2] + pad, w), min(box[3] + pad, h))
+        found = self.find_in(frame, rect)
+        if found is None:
+            return None
+        c, bbox = found
+
+        # touching the region border where it is not the frame border, it may go on outside
+        topx, topy, botx, boty = bbox
+        if (rect[0] > 0 and topx <= rect[0] + 1) or (rect[1] > 0 and topy <= rect[1] + 1) \
+                or (rect[2] < w and botx >= rect[2] - 2) or (rect[3] < h and boty >= rect[3] - 2):
+            return None
+
+        # a blob not wholly inside the region, about as large as the ones inside, may be the largest of the frame
+        inside = (np.maximum(boxes[:, 0], 0) >= rect[0]) & (np.maximum(boxes[:, 1], 0) >= rect[1]) \
+            & (np.minimum(boxes[:, 2], w) <= rect[2]) & (np.minimum(boxes[:, 3], h) <= rect[3])
+        if (~inside).any() and area[~inside].max() >= self.ratio * area[inside].max(initial=0):
+            return None
+
+        return c, bbox
+
+    def check(self, frame, c, bbox):
+        """returns the name of the first quality gate the contour fails, None if it passes them all"""
+        g = self.gates
+        if not any(v for v in g.values()):
+            return None
+        m = quality.metrics(frame, c, bbox)
+        if g['min_area'] is not None and m['area'] < g['min_area']:
+            return 'min_area'
+        if g['max_area'] is not None and m['area'] > g['max_area']:
+            return 'max_area'
+        if g['min_solidity'] is not None and m['solidity'] < g['min_solidity']:
+            return 'min_solidity'
+        if g['border'] and m['border']:
+            return 'border'
+        if g['min_sharpness'] is not None and m['sharpness'] < g['min_sharpness']:
+            return 'min_sharpness'
+        return None
+
+    def accept(self, key):
+        """adds the perceptual hash of a mask to the index, unless it is a near-duplicate of a saved mask"""
+        if self.dedup is None or key is None:
+            return True
+        if len(self.hashes) and quality.hamming(self.hashes, key).min() <= self.dedup:
+            self.stats.count('rejected_duplicate')
+            return False
+        self.hashes = np.vstack([self.hashes, key])
+        return True
+
+    @instrument.timed('create_mask')
+    def create_mask(self, frame, found=None):
+        """returns the frame blacked out outside the object, and the bbox"""
+        c, bbox_coord = found if found is not None else self.find_object(frame)
+        extLeft, extTop = bbox_coord[:2]
+        extRight, extBot = bbox_coord[2:]
+        box = (slice(extTop, extBot + 1), slice(extLeft, extRight + 1))
+
+        # the contour lies within its bbox, so only the bbox is masked
+        if self.reuse:
+            masked, mask, _, _ = self.frame_buffers(frame)
+            if self.dirty is not None:
+                topx, topy, botx, boty = self.dirty
+                masked[topy:boty + 1, topx:botx + 1] = 0
+            self.dirty = bbox_coord
+            mask = mask[box]
+            mask[...] = 0
+        else:
+            masked = np.zeros_like(frame)
+            mask = np.zeros((extBot - extTop + 1, extRight - extLeft + 1), dtype=np.uint8)
+
+        # mask generation and masking in one pass over the bbox
+        cv2.drawContours(mask, [c], -1, 255, cv2.FILLED, offset=(-extLeft, -extTop))
+        cv2.copyTo(frame[box], mask, masked[box])
 
         # show image if in test mode
         if self.vis:
             print('visualize')
             cv2.drawContours(frame, [c], -1, (255, 255, 255), 0)
-            cv2.rectangle(frame, (extLeft[0], extTop[1]), (extRight[0], extBot[1]), (0, 0, 255), thickness=10) # (0,0,255) is red for opencv
-                
-            util.showimg(masked, bgr=True)
-            util.showimg(frame, bgr=True)
+            cv2.rectangle(frame, (extLeft, extTop), (extRight, extBot), (0, 0, 255), thickness=10) # (0,0,255) is red for opencv
+
+            # matplotlib is only loaded in test mode
+            import vis
+            vis.showimg(masked, bgr=True)
+            vis.showimg(frame, bgr=True)
 	
         return masked, bbox_coord
 
-    def save_mask(self, mask, ind):
-        path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data'))
-        path = path + '/' + 'mask/'
+    @instrument.timed('create_mask')
+    def create_crop(self, frame, found=None):
+        """returns the object cropped to its bbox, its binary alpha, and the bbox"""
+        c, bbox_coord = found if found is not None else self.find_object(frame)
+        topx, topy, botx, boty = bbox_coord
+
+        # alpha of the contour inside the bbox only
+        alpha = np.zeros((boty - topy, botx - topx), dtype=np.uint8)
+        cv2.drawContours(alpha, [c], -1, 255, cv2.FILLED, offset=(-topx, -topy))
+
+        crop = frame[topy:boty, topx:botx]
+        crop = cv2.bitwise_and(crop, crop, mask=alpha)
+
+        return crop, alpha, bbox_coord
+
+    def extract(self, frame, dedup=True):
+        """
+        returns the mask ready to be stored in the output format, its bbox and its perceptual
+        hash. The mask is None if nothing is found in the frame, if it fails a quality gate,
+        or with dedup, if it is a near-duplicate of a saved mask, and it is then not encoded.
+        Worker processes leave dedup to the parent, which sees the masks in order
+        """
+        found = self.find_object(frame)
+        if found is None:
+            self.stats.count('rejected_empty')
+            return None, None, None
+        with self.stats.stage('quality'):
+            failed = self.check(frame, *found)
+            key = quality.phash(frame, found[1]) if self.dedup is not None and failed is None else None
+        if failed is not None:
+            self.stats.count(f'rejected_{failed}')
+            return None, found[1], None
+        if dedup and not self.accept(key):
+            return None, found[1], None
+
+        if self.fmt == 'shard':
+            crop, alpha, bbox = self.create_crop(frame, found)
+            with self.stats.stage('encode'):
+                record = maskShard.encode(crop, alpha)
+            return record, bbox, key
+        masked, bbox = self.create_mask(frame, found)
+        with self.stats.stage('encode'):
+            buf = cv2.imencode('.jpg', masked)[1].tobytes()
+
+        return buf, bbox, key
+
+    @instrument.timed('save_mask')
+    def store(self, payload, bbox, num, ind):
+        """stores a mask returned by extract"""
+        if self.fmt == 'shard':
+            if self.shard is None:
+                self.shard = maskShardWriter(self.shard_path())
+            self.shard.add(payload, bbox, ind)
+        else:
+            self.write_mask(payload, num)
+            self.save_bbox(bbox)
+        self.stats.count('masks')
+
+    def close(self):
+        """writes the shard index when storing in shard format"""
+        if self.shard is not None:
+            self.shard.close()
+            self.shard = None
+
+    def generate_pipelined(self, cap, workers, queue_size=None, **sample_args):
+        """
+        runs generate mode as a pipeline and returns the number of masks saved
+
+        a decoder thread samples the frames, a pool of worker processes runs
+        extract (create_mask or create_crop, and JPEG encode), and the calling thread writes the
+        results in frame order. At most queue_size frames are decoded and
+        waiting, and at most queue_size results are in flight, which bounds
+        the memory. Output is identical to the serial path. The stats of the
+        workers come back with their results. Near-duplicates are dropped here,
+        after the workers encoded them, since only this thread sees the masks in order.
+        If decoding a frame or writing a result fails, the decoder and the pool are stopped and
+        the error is raised.
+        """
+        if queue_size is None:
+            queue_size = 2 * workers
+        frames = queue.Queue(maxsize=queue_size)
+        slots = threading.BoundedSemaphore(queue_size)
+        stop = threading.Event()
+        errors = []     # raised in the decoder thread, re-raised by the calling thread
+
+        # the decoder and the pool's task handler wait with a timeout, to give up once stop is set
+        def put(item):
+            while not stop.is_set():
+                try:
+                    frames.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def decode():
+            try:
+                for item in self.sample_frames(cap, **sample_args):
+                    if not put(item):
+                        return
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                put(None)
+
+        def feed():
+            while not stop.is_set():
+                try:
+                    item = frames.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    return
+                while not slots.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                yield item
+
+        pool = mp.Pool(workers, initializer=_init_worker, initargs=(self.low, self.high, self.fmt, self.gates, self.dedup,
+                                                                  (self.search, self.levels, self.pad, self.ratio)))
+        decoder = threading.Thread(target=decode, daemon=True)
+        decoder.start()
+
+        num = 0 # mask counter
+        try:
+            for ind, payload, bbox, key, stats in pool.imap(_mask_worker, feed()):
+                self.stats.merge(stats)
+                slots.release()
+                if payload is None or not self.accept(key):
+                    continue
+                self.store(payload, bbox, num, ind)
+                print(f'[INFO] mask #{num} saved (frame {ind})')
+                num += 1
+                self.stats.step(num, frame=ind)
+            if errors:
+                raise errors[0]
+        except BaseException:
+            stop.set()
+            pool.terminate()
+            pool.join()
+            decoder.join()
+            raise
+        pool.close()
+        pool.join()
+        decoder.join()
+
+        return num
+
+    def mask_dir(self):
+        if self.outDir is not None:
+            path = os.path.abspath(self.outDir) + '/'
+        else:
+            path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data'))
+            path = path + '/' + 'mask/'
         if not os.path.exists(path):
-           os.makedirs(path)
-        self.maskname = path + f'{self.obj_name}_mask_{int(ind/10)}.jpg'
-        cv2.imwrite(self.maskname, mask)
+           os.makedirs(path, exist_ok=True)
+        return path
+
+    def mask_path(self, num):
+        return self.mask_dir() + f'{self.obj_name}_mask_{num}.jpg'
+
+    def shard_path(self):
+        return self.mask_dir() + f'{self.obj_name}_mask.shard'
+
+    def bbox_path(self):
+        return self.mask_dir() + f'{self.obj_name}_mask_bbox.txt'
+
+    def write_mask(self, buf, num):
+        """writes a mask already encoded as JPEG bytes"""
+        self.maskname = self.mask_path(num)
+        with open(self.maskname, 'wb') as f:
+            f.write(buf)
 
     def save_bbox(self, bbox_coord):
-        path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data'))
-        path = path + '/' + 'mask/'
-        bbox_test = path + f'{self.obj_name}_mask_bbox.txt'
-        f = open(bbox_test, 'a+')
-        f.write(f'{self.maskname},{(bbox_coord[0], bbox_coord[1])},{(bbox_coord[2], bbox_coord[3])}\n')
+        with open(self.bbox_path(), 'a+') as f:
+            f.write(f'{self.maskname},{(bbox_coord[0], bbox_coord[1])},{(bbox_coord[2], bbox_coord[3])}\n')
+
+
+_worker = None  # generateMask instance of a pipeline worker process
+
+def _init_worker(low, high, fmt, gates, dedup, search):
+    global _worker
+    _worker = generateMask()
+    _worker.set_buffers(True)   # masks are encoded right away
+    _worker.set_thresh((low, high))
+    _worker.set_format(fmt)
+    _worker.set_search(*search)
+    _worker.set_quality(dedup=dedup, **gates)
+
+def _mask_worker(item):
+    """extracts the mask of a single frame in a worker process, None if it fails"""
+    ind, frame = item
+    try:
+        payload, bbox, key = _worker.extract(frame, dedup=False)
+    except Exception as e:
+        # a bad frame is skipped rather than stopping the pipeline
+        print(f'[INFO] frame {ind} skipped: {e!r}')
+        _worker.stats.count('failed')
+        payload, bbox, key = None, None, None
+    return ind, payload, bbox, key, _worker.stats.drain()
+
+def configure(gen_mask, args):
+    """sets up a generateMask for generate mode from the arguments"""
+    gen_mask.set_thresh(args['thresh'])
+    gen_mask.set_format(args['format'])
+    gen_mask.set_outDir(args['dest'])
+    gen_mask.set_stats(args['stats'], args['every'])
+    gen_mask.set_search(args['search'])
+    gen_mask.set_buffers(True)  # masks are encoded right away
+    gen_mask.set_quality(args['min_area'], args['max_area'], args['min_solidity'], args['border'],
+                         args['min_sharpness'], args['dedup'])
+
+def parse_ranges(args):
+    """returns the time ranges to sample as (start, end) tuples, None for the whole video"""
+    if args['range'] is None:
+        return None
+    ranges = []
+    for item in args['range']:
+        start, end = item.split('-')
+        ranges.append((float(start), float(end) if end else None))
+    return ranges
+
+VIDEO_EXT = ('.mov', '.mp4', '.avi', '.mkv', '.m4v')
+
+def find_videos(source, obj=None):
+    """
+    returns the (video, object) pairs of a batch
+
+    args:
+        source: manifest file with a video,object line per video, paths relative to the
+                manifest, or directory of videos, <object>/<video> or <video> of object obj
+    """
+    jobs = []
+    if os.path.isfile(source):
+        root = os.path.dirname(os.path.abspath(source))
+        with open(source, 'r') as f:
+            for line in f.read().split('\n'):
+                line = line.strip()
+                if len(line) == 0 or line.startswith('#'):
+                    continue
+                video, name = [item.strip() for item in line.rsplit(',', 1)]
+                jobs.append((os.path.join(root, video), name))
+        return jobs
+
+    for path in sorted(glob.glob(os.path.join(source, '**', '*'), recursive=True)):
+        if not path.lower().endswith(VIDEO_EXT):
+            continue
+        sub = os.path.relpath(os.path.dirname(path), source)
+        name = sub.split(os.sep)[0] if sub != '.' else obj
+        assert name is not None, f'{path} is not in an object directory, set the object name with -o'
+        jobs.append((path, name))
+    return jobs
+
+def batch(source, args):
+    """
+    extracts the masks of many videos at once and returns the number of masks saved
+
+    the videos run in a pool of worker processes, the largest first, each one writing its own
+    masks, bbox file or shard named <object>_<video>. Once all are done, the bbox files or shards
+    are merged in manifest order into those of their object, by this process only, and removed
+    """
+    pairs = find_videos(source, args['object'])
+    jobs = []
+    used = set()
+    for video, obj in pairs:
+        name = f'{obj}_{os.path.splitext(os.path.basename(video))[0]}'
+        while name in used:
+            name += '_'
+        used.add(name)
+        jobs.append((video, obj, name, args))
+    print(f'[INFO] {len(jobs)} videos of {len(set(obj for _, obj in pairs))} objects')
+
+    results = {}
+    order = sorted(jobs, key=lambda job: -os.path.getsize(job[0]))
+    with mp.Pool(args['workers'] or os.cpu_count()) as pool:
+        for res in pool.imap_unordered(_batch_worker, order):
+            results[res['name']] = res
+            print(f'[INFO] {res["name"]}: {res["masks"]} masks from {res["sampled"]} frames ({len(results)}/{len(jobs)} videos)')
+
+    # merge per object, in manifest order
+    gen_mask = generateMask()
+    gen_mask.set_outDir(args['dest'])
+    stats = instrument.stageStats('batch', args['stats'], args['every'])
+    for obj in dict.fromkeys(obj for _, obj in pairs):
+        names = [name for _, o, name, _ in jobs if o == obj]
+        gen_mask.set_objName(obj)
+        parts = []
+        for name in names:
+            part = generateMask()
+            part.set_outDir(args['dest'])
+            part.set_objName(name)
+            parts.append(part)
+        if args['format'] == 'shard':
+            paths = [part.shard_path() for part in parts if os.path.exists(part.shard_path())]
+            maskShard.merge(paths, gen_mask.shard_path())
+        else:
+            with open(gen_mask.bbox_path(), 'a') as f:
+                for part in parts:
+                    if os.path.exists(part.bbox_path()):
+                        with open(part.bbox_path(), 'r') as p:
+                            f.write(p.read())
+                        os.remove(part.bbox_path())
+        print(f'[INFO] {obj}: {sum(results[name]["masks"] for name in names)} masks from {len(names)} videos merged')
+    for res in results.values():
+        stats.merge(res['stats'])
+    stats.report()
+
+    return sum(res['masks'] for res in results.values())
+
+def _batch_worker(job):
+    """extracts the masks of one video of a batch in a worker process"""
+    video, obj, name, args = job
+    gen_mask = generateMask()
+    gen_mask.set_objName(name)
+    configure(gen_mask, args)
+    gen_mask.stats.log = None   # the parent reports the whole batch
+    cap = gen_mask.load_video(video)
+    with open(os.devnull, 'w') as null, redirect_stdout(null):
+        num = generate(gen_mask, cap, dict(args, workers=0), parse_ranges(args))
+    gen_mask.close()
+    cap.release()
+
+    return {'name': name, 'masks': num, 'sampled': gen_mask.sample_stats['sampled'], 'stats': gen_mask.stats.summary()}
+
+def generate(gen_mask, cap, args, ranges):
+    """runs generate mode serially or pipelined, and returns the number of masks saved"""
+    if args['workers'] > 0:
+        return gen_mask.generate_pipelined(cap, args['workers'], args['queue'],
+                                           stride=args['stride'], rate=args['rate'], ranges=ranges)
+    else:
+        num = 0 # mask counter
+        for ind, frame in gen_mask.sample_frames(cap, args['stride'], args['rate'], ranges):
+            payload, bbox, _ = gen_mask.extract(frame)
+            if payload is None:
+                continue
+            gen_mask.store(payload, bbox, num, ind)
+            print(f'[INFO] mask #{num} saved (frame {ind})')
+            num += 1
+            gen_mask.stats.step(num, frame=ind)
+        return num
 
 
 def main():
@@ -89,23 +705,44 @@ def main():
     Mode:
         - generate: generate mask
         - test: test threshold value
+        - batch: generate masks of all the videos of a directory or manifest
     """
     # parse arguments
     ap = argparse.ArgumentParser(description='Generate Object Mask From Video.')
-    ap.add_argument("-m", "--mode", required=True, help="test or generate")
-    ap.add_argument("-v", "--video", required=True, help="video file")
-    ap.add_argument("-o", "--object", required=True, help="name of an object")
+    ap.add_argument("-m", "--mode", required=True, help="test, generate or batch")
+    ap.add_argument("-v", "--video", required=True, help="video file, or directory or manifest of videos in batch mode")
+    ap.add_argument("-o", "--object", default=None, help="name of an object")
+    ap.add_argument("-d", "--dest", default=None, help="output directory of the masks (default data/mask)")
     ap.add_argument("-t", "--thresh", type=int, default="100 255", nargs='+', help="image extraction threshold. Range between 0-255")
+    ap.add_argument("-s", "--stride", type=int, default=10, help="keep every n-th frame in generate mode")
+    ap.add_argument("-r", "--rate", type=float, default=None, help="target masks per second of video. Overrides stride")
+    ap.add_argument("--range", nargs='+', default=None, help="time ranges to sample in seconds, e.g. 2-10 15-20")
+    ap.add_argument("-w", "--workers", type=int, default=0, help="number of worker processes for pipelined generate mode. 0 runs serially. Videos processed at once in batch mode (default: all cores)")
+    ap.add_argument("-f", "--format", default='jpg', help="output format, jpg or shard")
+    ap.add_argument("-q", "--queue", type=int, default=None, help="max number of frames in flight in pipelined mode (default 2 x workers)")
+    ap.add_argument("--search", default='full', help="object search, full or fast (subsampled frame and tracked region)")
+    ap.add_argument("--min-area", type=float, default=None, help="drop masks smaller than this fraction of the frame")
+    ap.add_argument("--max-area", type=float, default=None, help="drop masks larger than this fraction of the frame")
+    ap.add_argument("--min-solidity", type=float, default=None, help="drop masks with a lower area over convex hull area, e.g. 0.8")
+    ap.add_argument("--border", action='store_true', help="drop masks touching the frame border")
+    ap.add_argument("--min-sharpness", type=float, default=None, help="drop masks with a lower variance of the Laplacian, i.e. blurred")
+    ap.add_argument("--dedup", type=int, default=None, help="drop masks within this Hamming distance (0-64) of the perceptual hash of a saved mask, e.g. 6")
+    ap.add_argument("--stats", default=None, help="file to append JSON progress lines and the summary to, - for stdout")
+    ap.add_argument("--every", type=int, default=100, help="masks between two progress lines")
+    ap.add_argument("--profile", default=None, help="file to dump cProfile stats of generate mode to")
     args = vars(ap.parse_args())
 
     # mode assertion
-    assert (args['mode'] == 'test' or args['mode'] == 'generate'), 'Mode should be either \'test\' or \'generate\'.'
+    assert (args['mode'] in ['test', 'generate', 'batch']), 'Mode should be one of the followings: \'test\', \'generate\', \'batch\'.'
+    assert (args['mode'] != 'generate' or args['object'] is not None), 'Object name is required in generate mode.'
     
     # get path
     PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data', 'video')) 
 
     # video file
     vid_file = PATH + '/' + args['video']
+    if args['mode'] == 'batch' and os.path.exists(args['video']):
+        vid_file = args['video']
 
     # mode selection
     if args['mode'] == 'test':
@@ -120,7 +757,12 @@ def main():
         while True:
             ret, frame = cap.read()
             if ret:
-                _, _ = test_mask.create_mask(frame)
+                found = test_mask.find_object(frame)
+                if found is None:
+                    print('[INFO] nothing above the threshold in the first frame')
+                    break
+                print(f'[INFO] quality {quality.metrics(frame, *found)}')
+                _, _ = test_mask.create_mask(frame, found)
             break    
         cap.release()
 
@@ -128,23 +770,32 @@ def main():
         print('[INFO] generate mode initiated')
         gen_mask = generateMask()
         gen_mask.set_objName(args['object'])
-        gen_mask.set_thresh(args['thresh'])
+        configure(gen_mask, args)
 
-        # iterate through all the frames
+        # time ranges to sample
+        ranges = parse_ranges(args)
+
+        # iterate through the sampled frames only
         cap = gen_mask.load_video(vid_file)
         print('[INFO] video file loaded')
-        ind = 0 # frame index
-        while True:
-            ret, frame = cap.read()
-            if ret and ind % 10 == 0:   # 3 pics/sec
-                masked, bbox = gen_mask.create_mask(frame)
-                gen_mask.save_mask(masked, ind)
-                gen_mask.save_bbox(bbox)
-                print(f'[INFO] mask #{int(ind/10)} saved') 
-            ind += 1
-            if not ret:
-                break
+        if args['profile']:
+            instrument.profiled(args['profile'], generate, gen_mask, cap, args, ranges)
+        else:
+            generate(gen_mask, cap, args, ranges)
+        gen_mask.close()
         cap.release()
+
+        stats = gen_mask.sample_stats
+        print(f'[INFO] {stats["sampled"]} of {stats["grabbed"]} frames sampled, effective rate {stats["rate"]:.2f} masks/sec')
+        gen_mask.stats.report()
+
+    elif args['mode'] == 'batch':
+        print('[INFO] batch mode initiated')
+        if args['profile']:
+            num = instrument.profiled(args['profile'], batch, vid_file, args)
+        else:
+            num = batch(vid_file, args)
+        print(f'[INFO] {num} masks saved')
     
 if __name__ == '__main__':
     main()